@@ -0,0 +1,226 @@
+"""
+Move generation for many positions at once with NumPy, for building datasets
+"""
+
+import random
+import sys
+from time import perf_counter
+
+try:
+    import numpy as np
+except ImportError as error: # NumPy is only needed for this module, chess.py and the rest run without it
+    if __name__ == '__main__':
+        sys.exit('batch.py needs NumPy: pip install numpy')
+    raise ImportError('batch.py needs NumPy: pip install numpy') from error
+
+from chess import (BISHOP_RAYS, KING_ATTACKS, KNIGHT_ATTACKS, PAWN_ATTACKS, ROOK_RAYS, Game, Position, bit_squares,
+                   reverse_UCI_map)
+
+# Boards are (N, 64) int8 arrays of the ord() of each square's type_, a1 first like the Board list, ' ' when empty
+EMPTY = ord(' ')
+WHITE_PIECES = 'PNBRQK'
+BLACK_PIECES = 'pnbrqk'
+SQUARES = np.arange(64, dtype=np.uint64)
+BITS = np.uint64(1) << SQUARES # BITS[sq] is the bitboard of one square
+ONE = np.uint64(1)
+
+KNIGHT_TABLE = np.array(KNIGHT_ATTACKS, dtype=np.uint64)
+KING_TABLE = np.array(KING_ATTACKS, dtype=np.uint64)
+PAWN_TABLES = {color: np.array(table, dtype=np.uint64) for color, table in PAWN_ATTACKS.items()}
+ROOK_TABLES = [(np.array(ray, dtype=np.uint64), increasing) for ray, increasing in ROOK_RAYS]
+BISHOP_TABLES = [(np.array(ray, dtype=np.uint64), increasing) for ray, increasing in BISHOP_RAYS]
+
+# Pushes by square, 0 where a pawn can't be or can't push
+PUSH_ONE = {'White': np.array([1 << sq + 8 if sq < 56 else 0 for sq in range(64)], dtype=np.uint64),
+            'Black': np.array([1 << sq - 8 if sq >= 8 else 0 for sq in range(64)], dtype=np.uint64)}
+PUSH_TWO = {'White': np.array([1 << sq + 16 if 8 <= sq < 16 else 0 for sq in range(64)], dtype=np.uint64),
+            'Black': np.array([1 << sq - 16 if 48 <= sq < 56 else 0 for sq in range(64)], dtype=np.uint64)}
+
+
+def encode(positions) -> np.ndarray:
+    # Boards of Positions (or Boards) as an (N, 64) int8 array
+    return np.array([[ord(square.type_) for square in getattr(position, 'board', position)] for position in positions], dtype=np.int8)
+
+
+LOOKUPS = {}
+
+
+def holding(codes: np.ndarray, letters) -> np.ndarray:
+    # Bool array of the codes that are one of the letters, through a 256 entry lookup table made once per letters
+    if letters not in LOOKUPS:
+        LOOKUPS[letters] = np.zeros(256, dtype=bool)
+        LOOKUPS[letters][[ord(letter) for letter in letters]] = True
+    return LOOKUPS[letters][codes.view(np.uint8)]
+
+
+def bitboards(boards: np.ndarray, letters) -> np.ndarray:
+    # (N,) uint64 bitboards of the squares holding any of the piece letters, bit n for square n as in chess.py
+    marked = holding(boards, letters)
+    return np.packbits(marked, axis=1, bitorder='little').view('<u8')[:, 0].astype(np.uint64)
+
+
+def to_squares(bitboards: np.ndarray) -> np.ndarray:
+    # Bitboards of any shape to bool arrays with a last axis of 64 squares
+    return (bitboards[..., None] & BITS) != 0
+
+
+def popcount(bitboards: np.ndarray) -> np.ndarray:
+    if hasattr(np, 'bitwise_count'): # NumPy 2
+        return np.bitwise_count(bitboards).astype(np.int64)
+    return np.unpackbits(bitboards[..., None].view(np.uint8), axis=-1).sum(axis=-1, dtype=np.int64)
+
+
+def highest_bit(bitboards: np.ndarray) -> np.ndarray:
+    # Keeps only the highest set bit, 0 stays 0
+    smeared = bitboards.copy()
+    for shift in (1, 2, 4, 8, 16, 32):
+        smeared |= smeared >> np.uint64(shift)
+    return smeared ^ (smeared >> ONE)
+
+
+def slide(occupancy: np.ndarray, squares: np.ndarray, tables) -> np.ndarray:
+    # Attacks of sliders on the given squares with the given occupancies, each ray cut after its first blocker
+    # A ray going up keeps the squares up to its lowest blocker, a ray going down those down to its highest
+    attacks = np.zeros(len(squares), dtype=np.uint64)
+    for table, increasing in tables:
+        ray = table[squares]
+        blockers = occupancy & ray
+        with np.errstate(over='ignore'):
+            if increasing:
+                lowest = blockers & (~blockers + ONE)
+                attacks |= ray & ((lowest << ONE) - ONE) # No blocker gives all ones, and so the whole ray
+            else:
+                attacks |= np.where(blockers != 0, ray & ~(highest_bit(blockers) - ONE), ray)
+    return attacks
+
+
+def piece_attacks(boards: np.ndarray):
+    # Every piece of every board as flat arrays: board row, square, type_ code and the squares it attacks (friendly
+    # pieces included). Only squares holding pieces are worked on, a quarter of the board or less
+    rows, squares = np.nonzero(boards != EMPTY)
+    squares = squares.astype(np.intp)
+    codes = boards[rows, squares]
+    lower = codes | 0x20 # Lower case letter, the color doesn't change what a piece attacks apart from pawns
+    occupancy = bitboards(boards, WHITE_PIECES + BLACK_PIECES)[rows]
+    attacks = np.zeros(len(rows), dtype=np.uint64)
+    for table, selected in ((PAWN_TABLES['White'], codes == ord('P')), (PAWN_TABLES['Black'], codes == ord('p')),
+                            (KNIGHT_TABLE, lower == ord('n')), (KING_TABLE, lower == ord('k'))):
+        attacks[selected] = table[squares[selected]]
+    for tables, letters in ((ROOK_TABLES, 'rq'), (BISHOP_TABLES, 'bq')):
+        selected = holding(lower, letters)
+        attacks[selected] |= slide(occupancy[selected], squares[selected], tables)
+    return rows, squares, codes, attacks
+
+
+def analyse(boards: np.ndarray) -> dict:
+    # Everything at once so the attacks are worked out a single time: for each color its (N, 64) uint64 targets()
+    # by square and its (N,) attacked squares, and the (N, 2) in check flags of White and Black
+    rows, squares, codes, attacks = piece_attacks(boards)
+    results = {}
+    for color, own, enemy in (('White', WHITE_PIECES, BLACK_PIECES), ('Black', BLACK_PIECES, WHITE_PIECES)):
+        selected = holding(codes, own)
+        own_rows, own_squares, own_attacks = rows[selected], squares[selected], attacks[selected]
+        own_occupied = bitboards(boards, own)[own_rows]
+        enemy_occupied = bitboards(boards, enemy)[own_rows]
+
+        # Pawns capture only enemy pieces and push onto empty squares, two steps only if the first is free too
+        empty = ~(own_occupied | enemy_occupied)
+        one_step = PUSH_ONE[color][own_squares] & empty
+        two_steps = np.where(one_step != 0, PUSH_TWO[color][own_squares] & empty, np.uint64(0))
+        is_pawn = codes[selected] == ord(own[0])
+        targets = np.where(is_pawn, own_attacks & enemy_occupied | one_step | two_steps, own_attacks & ~own_occupied)
+
+        by_square = np.zeros(boards.shape, dtype=np.uint64)
+        by_square[own_rows, own_squares] = targets
+        attacked_by_square = np.zeros(boards.shape, dtype=np.uint64)
+        attacked_by_square[own_rows, own_squares] = own_attacks
+        results[color] = by_square
+        results[color + ' attacks'] = np.bitwise_or.reduce(attacked_by_square, axis=1)
+    results['check'] = np.stack([bitboards(boards, 'K') & results['Black attacks'] != 0,
+                                 bitboards(boards, 'k') & results['White attacks'] != 0], axis=1)
+    return results
+
+
+def pseudo_legal_targets(boards: np.ndarray, color: str) -> np.ndarray:
+    # (N, 64) uint64 targets() of every piece of color by square, the same as legal_moves() in chess.py apart from
+    # castling and en passant, which depend on more than the board
+    return analyse(boards)[color]
+
+
+def attacked(boards: np.ndarray, color: str) -> np.ndarray:
+    # (N,) uint64 squares attacked by the pieces of color
+    return analyse(boards)[color + ' attacks']
+
+
+def in_check(boards: np.ndarray) -> np.ndarray:
+    # (N, 2) bool, whether the White and the Black king are attacked
+    return analyse(boards)['check']
+
+
+def move_counts(targets: np.ndarray) -> np.ndarray:
+    # (N,) number of pseudo-legal moves in (N, 64) targets, promotions counted once
+    return popcount(targets).sum(axis=1)
+
+
+def reference_positions(number = 1000, seed = 0) -> list:
+    # Positions from random games, rebuilt without castling rights or en passant so legal_moves() only has the
+    # moves the batch functions cover
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < number:
+        game = Game()
+        for _ in range(rng.randrange(1, 120)):
+            if game.result:
+                break
+            move_from, move_to, promotion = rng.choice(game.legal_moves)
+            game.play(f'{reverse_UCI_map[move_from]}{reverse_UCI_map[move_to]}{promotion or ""}')
+        placement, turn, *_ = game.position.to_fen().split()
+        positions.append(Position.from_fen(f'{placement} {turn} - - 0 1'))
+    return positions
+
+
+def verify(positions) -> int:
+    # Compares every piece's legal_moves() and King.check() with the batch results, returns the number of mismatches
+    results = analyse(encode(positions))
+    targets, checks = results, results['check']
+    mismatches = 0
+    for index, position in enumerate(positions):
+        board = position.board
+        for square in board:
+            if not square.is_empty():
+                expected = sorted(square.legal_moves(board)) # As returned, a square listed twice is a mismatch
+                if bit_squares(int(targets[square.color][index, square.position])) != expected:
+                    mismatches += 1
+                    print(f'{position.to_fen()}: {square.type_} on {reverse_UCI_map[square.position]}', file=sys.stderr)
+        for column, color in enumerate(('White', 'Black')):
+            if checks[index, column] != position.kings[color].check(board):
+                mismatches += 1
+                print(f'{position.to_fen()}: {color} check', file=sys.stderr)
+    return mismatches
+
+
+def main(args) -> int:
+    # 'python3 batch.py [positions]' checks the batch results against chess.py and times both
+    number = int(args[0]) if args else 1000
+    positions = reference_positions(number)
+    mismatches = verify(positions)
+    print(f'{len(positions)} positions, {mismatches} mismatches')
+
+    start = perf_counter()
+    for position in positions:
+        board = position.board
+        sum(len(square.legal_moves(board)) for square in board if square.color == position.turn)
+    per_piece = perf_counter() - start
+
+    boards = encode(positions)
+    start = perf_counter()
+    results = analyse(boards)
+    move_counts(results['White']), move_counts(results['Black'])
+    batched = perf_counter() - start
+    print(f'legal_moves() per piece: {len(positions) / per_piece:.0f} positions/s, '
+          f'batch (both colors and checks): {len(positions) / batched:.0f} positions/s')
+    return 0 if mismatches == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,159 @@
+"""
+Opening book for chess.py: Polyglot layout files read through mmap, and a builder from UCI move archives
+"""
+
+import mmap
+import os
+import random
+import struct
+import sys
+
+from chess import UCI_MOVE, UCI_map, Game, IllegalMove, Position, read_games, reverse_UCI_map
+
+# Polyglot layout: 16 byte big endian entries, key, move, weight and learn, sorted by key
+# The keys are Position.key rather than the Polyglot random numbers, so books are made with build_book() and
+# books from elsewhere won't match
+ENTRY = struct.Struct('>QHHI')
+PROMOTION_CODES = {None: 0, 'n': 1, 'b': 2, 'r': 3, 'q': 4}
+PROMOTION_LETTERS = {code: letter for letter, code in PROMOTION_CODES.items()}
+# Polyglot writes castling as the king taking its own rook
+CASTLING_MOVES = {(4, 6): 7, (4, 2): 0, (60, 62): 63, (60, 58): 56}
+CASTLING_SQUARES = {(king, rook): to for (king, to), rook in CASTLING_MOVES.items()}
+RESULT_POINTS = {'1-0': {'White': 2, 'Black': 0}, '0-1': {'White': 0, 'Black': 2}} # Anything else is 1 each
+
+
+def encode_move(position, move) -> int:
+    # Bits 0-5 destination and 6-11 origin with a1 = 0 like UCI_map, 12-14 promotion
+    move_from, move_to, promotion = move
+    if position.board[move_from].type_ in 'Kk' and (move_from, move_to) in CASTLING_MOVES:
+        move_to = CASTLING_MOVES[(move_from, move_to)]
+    return move_to | move_from << 6 | PROMOTION_CODES[promotion] << 12
+
+
+def decode_move(position, code):
+    move_from, move_to, promotion = code >> 6 & 63, code & 63, PROMOTION_LETTERS.get(code >> 12 & 7)
+    if position.board[move_from].type_ in 'Kk' and (move_from, move_to) in CASTLING_SQUARES:
+        move_to = CASTLING_SQUARES[(move_from, move_to)]
+    return move_from, move_to, promotion
+
+
+class OpeningBook:
+    # Looks moves up by binary search over the memory mapped file, so a lookup reads a few pages of the file and
+    # the book is never loaded as a whole
+
+    def __init__(self, path) -> None:
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.count = size // ENTRY.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.map:
+            self.map.close()
+        self.file.close()
+
+    def key_at(self, index: int) -> int:
+        return struct.unpack_from('>Q', self.map, index * ENTRY.size)[0]
+
+    def entries(self, key: int) -> list:
+        # (move, weight, learn) of every entry for the key
+        low, high = 0, self.count
+        while low < high: # First entry with a key not below the one looked for
+            middle = (low + high) // 2
+            if self.key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        found = []
+        while low < self.count:
+            entry_key, move, weight, learn = ENTRY.unpack_from(self.map, low * ENTRY.size)
+            if entry_key != key:
+                break
+            found.append((move, weight, learn))
+            low += 1
+        return found
+
+    def moves(self, position: Position) -> list:
+        # [(move, weight)] for the position, moves as (move_from, move_to, promotion) and only legal ones,
+        # a different position with the same key can't slip an impossible move in
+        legal = position.generate_legal_moves()
+        moves = []
+        for code, weight, _ in self.entries(position.key):
+            move = decode_move(position, code)
+            if move in legal:
+                moves.append((move, weight))
+        return moves
+
+    def choose(self, position: Position, rng = random):
+        # A move picked at random in proportion to the weights, None when the position is not in the book
+        moves = [(move, weight) for move, weight in self.moves(position) if weight]
+        if not moves:
+            return None
+        return rng.choices([move for move, _ in moves], weights=[weight for _, weight in moves])[0]
+
+
+def build_book(paths, output, plies = 20) -> int:
+    # Writes a book of the first plies of every game in the archives, each move weighted by how often it was
+    # played and how it went for the side playing it: 2 points a win, 1 a draw or unfinished game, 0 a loss
+    weights = {}
+    for path in paths:
+        with open(path) as file:
+            for _, moves in read_games(file):
+                game, played = Game(), []
+                for uci in moves[:plies]:
+                    position = game.position
+                    if not UCI_MOVE.match(uci):
+                        break
+                    move_from, move_to = UCI_map[uci[:2]], UCI_map[uci[2:4]]
+                    promotion = uci[4:] or ('q' if position.board[move_from].type_ in 'Pp' and move_to // 8 in (0, 7) else None)
+                    entry = (position.key, encode_move(position, (move_from, move_to, promotion)), position.turn)
+                    try:
+                        game.play(uci)
+                    except IllegalMove:
+                        break # Keeps the moves up to the first illegal one
+                    played.append(entry)
+                for uci in moves[len(played):]: # The rest of the game is only played for its result
+                    try:
+                        game.play(uci)
+                    except IllegalMove:
+                        break
+                result = RESULT_POINTS.get(game.result, {'White': 1, 'Black': 1})
+                for key, code, color in played:
+                    weights[key, code] = weights.get((key, code), 0) + result[color]
+
+    top = max(weights.values(), default=0)
+    scale = max(1, -(-top // 65535)) # Weights are 16 bit, scaled down together if the archive is big
+    with open(output, 'wb') as file:
+        for (key, code), weight in sorted(weights.items(), key=lambda item: (item[0][0], -item[1])):
+            file.write(ENTRY.pack(key, code, weight // scale, 0))
+    return len(weights)
+
+
+def main(args) -> int:
+    # 'python3 book.py build book.bin file... [--plies n]' makes a book from UCI move archives,
+    # 'python3 book.py probe book.bin [fen]' lists the book moves of a position
+    if args[:1] == ['build'] and len(args) >= 3:
+        plies = 20
+        if '--plies' in args:
+            index = args.index('--plies')
+            plies, args = int(args[index + 1]), args[:index] + args[index + 2:]
+        print(f'{build_book(args[2:], args[1], plies)} entries written to {args[1]}')
+        return 0
+    if args[:1] == ['probe'] and len(args) >= 2:
+        position = Position.from_fen(' '.join(args[2:])) if len(args) > 2 else Game().position
+        with OpeningBook(args[1]) as book:
+            for (move_from, move_to, promotion), weight in book.moves(position):
+                print(f'{reverse_UCI_map[move_from]}{reverse_UCI_map[move_to]}{promotion or ""} {weight}')
+        return 0
+    print('usage: book.py build book.bin file... [--plies n] | book.py probe book.bin [fen]')
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -4,9 +4,17 @@ Command Line Chess
 Alexander Michael Pommer Alba
 """
 
-from time import sleep
+import os
+import random
+import re
+import shutil
+import sys
+import tracemalloc
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from time import perf_counter, sleep
 
-BOARD = [] # 1d board that stores instances of Squares or Pieces
 UCI_map = {} # Universal Chess Interface dictionary to map player input
 LETTERS = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
 counter = 0
@@ -15,11 +23,381 @@ for number in range(1,9):
         UCI_map[f'{letter}{number}'] = counter
         counter += 1
 reverse_UCI_map = {value: key for key, value in UCI_map.items()} # Helps users see legal moves for a selected piece
-KINGS = {} # Tracks kings to make checks easier to compute
-EN_PASSANT = [] # Tracks pawns capable of an en passant move, helps remove such capacity after one turn
+
+
+# Bitboards: a 64 bit integer where bit n is set if square n (same numbering as UCI_map, a1 = 0 ... h8 = 63) is marked
+# BYTE_SQUARES[k][byte] lists the squares set in the k-th byte of a bitboard, so reading one takes at most 8 lookups
+BYTE_SQUARES = [[[k * 8 + bit for bit in range(8) if byte >> bit & 1] for byte in range(256)] for k in range(8)]
+
+
+def bit_squares(bitboard: int) -> list:
+    squares = []
+    for byte_squares in BYTE_SQUARES:
+        if not bitboard:
+            break
+        if bitboard & 255:
+            squares += byte_squares[bitboard & 255]
+        bitboard >>= 8
+    return squares
+
+
+def jump_table(steps) -> list:
+    # For each square, the bitboard of squares reached by a single (rank, file) step that stays on the board
+    table = []
+    for sq in range(64):
+        rank, file = sq // 8, sq % 8
+        bitboard = 0
+        for rank_step, file_step in steps:
+            if 0 <= rank + rank_step < 8 and 0 <= file + file_step < 8:
+                bitboard |= 1 << ((rank + rank_step) * 8 + file + file_step)
+        table.append(bitboard)
+    return table
+
+
+def ray_table(rank_step, file_step) -> list:
+    # For each square, the bitboard of every square in one direction up to the edge of the board
+    table = []
+    for sq in range(64):
+        rank, file = sq // 8 + rank_step, sq % 8 + file_step
+        bitboard = 0
+        while 0 <= rank < 8 and 0 <= file < 8:
+            bitboard |= 1 << (rank * 8 + file)
+            rank, file = rank + rank_step, file + file_step
+        table.append(bitboard)
+    return table
+
+
+KNIGHT_ATTACKS = jump_table([(2, 1), (2, -1), (1, 2), (1, -2), (-1, 2), (-1, -2), (-2, 1), (-2, -1)])
+KING_ATTACKS = jump_table([(1, -1), (1, 0), (1, 1), (0, -1), (0, 1), (-1, -1), (-1, 0), (-1, 1)])
+PAWN_ATTACKS = {'White': jump_table([(1, -1), (1, 1)]), 'Black': jump_table([(-1, -1), (-1, 1)])}
+
+# Rays paired with True if they run towards higher squares, the nearest blocker is then the lowest set bit
+ROOK_RAYS = [(ray_table(1, 0), True), (ray_table(0, 1), True), (ray_table(-1, 0), False), (ray_table(0, -1), False)]
+BISHOP_RAYS = [(ray_table(1, 1), True), (ray_table(1, -1), True), (ray_table(-1, 1), False), (ray_table(-1, -1), False)]
+
+
+def between_table() -> list:
+    # BETWEEN[a][b] is the bitboard of squares strictly between a and b when they share a file, rank or diagonal
+    table = [[0] * 64 for _ in range(64)]
+    for rays in (ROOK_RAYS, BISHOP_RAYS):
+        for ray, increasing in rays:
+            for a in range(64):
+                for b in bit_squares(ray[a]):
+                    table[a][b] = ray[a] ^ ray[b] ^ (1 << b)
+    return table
+
+
+BETWEEN = between_table()
+
+
+def nearest_square(bitboard: int, increasing: bool) -> int:
+    # First set square met when walking a ray in the given direction
+    if increasing:
+        return (bitboard & -bitboard).bit_length() - 1
+    return bitboard.bit_length() - 1
+
+
+def slide_attacks(position: int, occupancy: int, rays) -> int:
+    attacks = 0
+    for ray, increasing in rays:
+        path = ray[position]
+        blockers = path & occupancy
+        if blockers:
+            # Cut the ray after the nearest blocker, which stays attacked
+            if increasing:
+                nearest = (blockers & -blockers).bit_length() - 1
+            else:
+                nearest = blockers.bit_length() - 1
+            path ^= ray[nearest]
+        attacks |= path
+    return attacks
+
+
+def relevant_squares(rays) -> list:
+    # For each square, the squares whose occupancy can change a slider's attacks: its rays without the edge
+    # square at their far end, since a piece there is attacked whether or not it is occupied
+    masks = []
+    for sq in range(64):
+        mask = 0
+        for ray, increasing in rays:
+            if ray[sq]:
+                mask |= ray[sq] ^ (1 << nearest_square(ray[sq], not increasing))
+        masks.append(mask)
+    return masks
+
+
+# Slider attacks are cached per square by the occupancy of its relevant squares, a few thousand entries at most,
+# so after warming up a rook or bishop lookup is a mask and a dictionary read instead of a walk along 4 rays
+ROOK_RELEVANT = relevant_squares(ROOK_RAYS)
+BISHOP_RELEVANT = relevant_squares(BISHOP_RAYS)
+ROOK_CACHE = [{} for _ in range(64)]
+BISHOP_CACHE = [{} for _ in range(64)]
+
+
+def rook_attacks(position: int, occupancy: int) -> int:
+    key = occupancy & ROOK_RELEVANT[position]
+    attacks = ROOK_CACHE[position].get(key)
+    if attacks is None:
+        attacks = ROOK_CACHE[position][key] = slide_attacks(position, key, ROOK_RAYS)
+    return attacks
+
+
+def bishop_attacks(position: int, occupancy: int) -> int:
+    key = occupancy & BISHOP_RELEVANT[position]
+    attacks = BISHOP_CACHE[position].get(key)
+    if attacks is None:
+        attacks = BISHOP_CACHE[position][key] = slide_attacks(position, key, BISHOP_RAYS)
+    return attacks
+
+
+ATTACKERS = {'White': 'PNBRQK', 'Black': 'pnbrqk'} # Piece types of each color
+
+
+# Evaluation: material and piece-square values (PeSTO), one set for the middlegame and one for the endgame, blended by
+# the phase, how much material other than pawns is left (knight and bishop 1, rook 2, queen 4, 24 at the start)
+# Tables are laid out as seen from White, rank 8 first
+MIDGAME_VALUES = {'P': 82, 'N': 337, 'B': 365, 'R': 477, 'Q': 1025, 'K': 0}
+ENDGAME_VALUES = {'P': 94, 'N': 281, 'B': 297, 'R': 512, 'Q': 936, 'K': 0}
+PHASE_WEIGHTS = {'P': 0, 'N': 1, 'B': 1, 'R': 2, 'Q': 4, 'K': 0}
+FULL_PHASE = 24
+MIDGAME_TABLES = {
+    'P': [  0,   0,   0,   0,   0,   0,   0,   0,
+           98, 134,  61,  95,  68, 126,  34, -11,
+           -6,   7,  26,  31,  65,  56,  25, -20,
+          -14,  13,   6,  21,  23,  12,  17, -23,
+          -27,  -2,  -5,  12,  17,   6,  10, -25,
+          -26,  -4,  -4, -10,   3,   3,  33, -12,
+          -35,  -1, -20, -23, -15,  24,  38, -22,
+            0,   0,   0,   0,   0,   0,   0,   0],
+    'N': [-167, -89, -34, -49,  61, -97, -15, -107,
+           -73, -41,  72,  36,  23,  62,   7,  -17,
+           -47,  60,  37,  65,  84, 129,  73,   44,
+            -9,  17,  19,  53,  37,  69,  18,   22,
+           -13,   4,  16,  13,  28,  19,  21,   -8,
+           -23,  -9,  12,  10,  19,  17,  25,  -16,
+           -29, -53, -12,  -3,  -1,  18, -14,  -19,
+          -105, -21, -58, -33, -17, -28, -19,  -23],
+    'B': [-29,   4, -82, -37, -25, -42,   7,  -8,
+          -26,  16, -18, -13,  30,  59,  18, -47,
+          -16,  37,  43,  40,  35,  50,  37,  -2,
+           -4,   5,  19,  50,  37,  37,   7,  -2,
+           -6,  13,  13,  26,  34,  12,  10,   4,
+            0,  15,  15,  15,  14,  27,  18,  10,
+            4,  15,  16,   0,   7,  21,  33,   1,
+          -33,  -3, -14, -21, -13, -12, -39, -21],
+    'R': [ 32,  42,  32,  51,  63,   9,  31,  43,
+           27,  32,  58,  62,  80,  67,  26,  44,
+           -5,  19,  26,  36,  17,  45,  61,  16,
+          -24, -11,   7,  26,  24,  35,  -8, -20,
+          -36, -26, -12,  -1,   9,  -7,   6, -23,
+          -45, -25, -16, -17,   3,   0,  -5, -33,
+          -44, -16, -20,  -9,  -1,  11,  -6, -71,
+          -19, -13,   1,  17,  16,   7, -37, -26],
+    'Q': [-28,   0,  29,  12,  59,  44,  43,  45,
+          -24, -39,  -5,   1, -16,  57,  28,  54,
+          -13, -17,   7,   8,  29,  56,  47,  57,
+          -27, -27, -16, -16,  -1,  17,  -2,   1,
+           -9, -26,  -9, -10,  -2,  -4,   3,  -3,
+          -14,   2, -11,  -2,  -5,   2,  14,   5,
+          -35,  -8,  11,   2,   8,  15,  -3,   1,
+           -1, -18,  -9,  10, -15, -25, -31, -50],
+    'K': [-65,  23,  16, -15, -56, -34,   2,  13,
+           29,  -1, -20,  -7,  -8,  -4, -38, -29,
+           -9,  24,   2, -16, -20,   6,  22, -22,
+          -17, -20, -12, -27, -30, -25, -14, -36,
+          -49,  -1, -27, -39, -46, -44, -33, -51,
+          -14, -14, -22, -46, -44, -30, -15, -27,
+            1,   7,  -8, -64, -43, -16,   9,   8,
+          -15,  36,  12, -54,   8, -28,  24,  14],
+}
+ENDGAME_TABLES = {
+    'P': [  0,   0,   0,   0,   0,   0,   0,   0,
+          178, 173, 158, 134, 147, 132, 165, 187,
+           94, 100,  85,  67,  56,  53,  82,  84,
+           32,  24,  13,   5,  -2,   4,  17,  17,
+           13,   9,  -3,  -7,  -7,  -8,   3,  -1,
+            4,   7,  -6,   1,   0,  -5,  -1,  -8,
+           13,   8,   8,  10,  13,   0,   2,  -7,
+            0,   0,   0,   0,   0,   0,   0,   0],
+    'N': [-58, -38, -13, -28, -31, -27, -63, -99,
+          -25,  -8, -25,  -2,  -9, -25, -24, -52,
+          -24, -20,  10,   9,  -1,  -9, -19, -41,
+          -17,   3,  22,  22,  22,  11,   8, -18,
+          -18,  -6,  16,  25,  16,  17,   4, -18,
+          -23,  -3,  -1,  15,  10,  -3, -20, -22,
+          -42, -20, -10,  -5,  -2, -20, -23, -44,
+          -29, -51, -23, -15, -22, -18, -50, -64],
+    'B': [-14, -21, -11,  -8,  -7,  -9, -17, -24,
+           -8,  -4,   7, -12,  -3, -13,  -4, -14,
+            2,  -8,   0,  -1,  -2,   6,   0,   4,
+           -3,   9,  12,   9,  14,  10,   3,   2,
+           -6,   3,  13,  19,   7,  10,  -3,  -9,
+          -12,  -3,   8,  10,  13,   3,  -7, -15,
+          -14, -18,  -7,  -1,   4,  -9, -15, -27,
+          -23,  -9, -23,  -5,  -9, -16,  -5, -17],
+    'R': [ 13,  10,  18,  15,  12,  12,   8,   5,
+           11,  13,  13,  11,  -3,   3,   8,   3,
+            7,   7,   7,   5,   4,  -3,  -5,  -3,
+            4,   3,  13,   1,   2,   1,  -1,   2,
+            3,   5,   8,   4,  -5,  -6,  -8, -11,
+           -4,   0,  -5,  -1,  -7, -12,  -8, -16,
+           -6,  -6,   0,   2,  -9,  -9, -11,  -3,
+           -9,   2,   3,  -1,  -5, -13,   4, -20],
+    'Q': [ -9,  22,  22,  27,  27,  19,  10,  20,
+          -17,  20,  32,  41,  58,  25,  30,   0,
+          -20,   6,   9,  49,  47,  35,  19,   9,
+            3,  22,  24,  45,  57,  40,  57,  36,
+          -18,  28,  19,  47,  31,  34,  39,  23,
+          -16, -27,  15,   6,   9,  17,  10,   5,
+          -22, -23, -30, -16, -16, -23, -36, -32,
+          -33, -28, -22, -43,  -5, -32, -20, -41],
+    'K': [-74, -35, -18, -18, -11,  15,   4, -17,
+          -12,  17,  14,  17,  17,  38,  23,  11,
+           10,  17,  23,  15,  20,  45,  44,  13,
+           -8,  22,  24,  27,  26,  33,  26,   3,
+          -18,  -4,  21,  24,  27,  23,   9, -11,
+          -19,  -3,  11,  21,  23,  16,   7,  -9,
+          -27, -11,   4,  13,  14,   4,  -5, -17,
+          -53, -34, -21, -11, -28, -14, -24, -43],
+}
+
+
+def square_values(values, tables) -> dict:
+    # Value of each piece type on each square including its material, positive for White and negative for Black
+    # Table index sq ^ 56 flips the rank so White reads its table from rank 1, Black reads it as is (its own view)
+    squares = {}
+    for type_, table in tables.items():
+        squares[type_] = [values[type_] + table[sq ^ 56] for sq in range(64)]
+        squares[type_.lower()] = [-values[type_] - table[sq] for sq in range(64)]
+    return squares
+
+
+MIDGAME_SQUARES = square_values(MIDGAME_VALUES, MIDGAME_TABLES)
+ENDGAME_SQUARES = square_values(ENDGAME_VALUES, ENDGAME_TABLES)
+PHASES = {**PHASE_WEIGHTS, **{type_.lower(): weight for type_, weight in PHASE_WEIGHTS.items()}}
+
+
+class Board(list):
+    # 1d list of Squares and Pieces backed by bitboards, every assignment keeps the bitboards in sync
+    __slots__ = ('pieces', 'occupied', 'occupancy', 'midgame', 'endgame', 'phase')
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.pieces = {type_: 0 for type_ in 'PNBRQKpnbrqk'} # One bitboard per piece type and color
+        self.occupied = {'White': 0, 'Black': 0} # Squares taken by each color
+        self.occupancy = 0 # Squares taken by any piece
+        self.midgame = 0 # Running material and piece-square totals from White's point of view
+        self.endgame = 0
+        self.phase = 0
+
+    def place(self, index: int, piece) -> None:
+        if piece.color != 'Empty':
+            bit = 1 << index
+            type_ = piece.type_
+            self.pieces[type_] |= bit
+            self.occupied[piece.color] |= bit
+            self.occupancy |= bit
+            self.midgame += MIDGAME_SQUARES[type_][index]
+            self.endgame += ENDGAME_SQUARES[type_][index]
+            self.phase += PHASES[type_]
+
+    def lift(self, index: int, piece) -> None:
+        if piece.color != 'Empty':
+            mask = ~(1 << index)
+            type_ = piece.type_
+            self.pieces[type_] &= mask
+            self.occupied[piece.color] &= mask
+            self.occupancy &= mask
+            self.midgame -= MIDGAME_SQUARES[type_][index]
+            self.endgame -= ENDGAME_SQUARES[type_][index]
+            self.phase -= PHASES[type_]
+
+    def evaluate(self) -> int:
+        # Blends the running totals by phase, more middlegame with more pieces on the board, from White's point of view
+        phase = min(self.phase, FULL_PHASE) # Promotions can push the phase past the start position's
+        blend = self.midgame * phase + self.endgame * (FULL_PHASE - phase)
+        return blend // FULL_PHASE if blend >= 0 else -(-blend // FULL_PHASE) # Rounds towards 0 so both colors score alike
+
+    def clear(self) -> None:
+        super().clear()
+        self.__init__()
+
+    def append(self, piece) -> None:
+        self.place(len(self), piece)
+        super().append(piece)
+
+    def fill(self, squares, state = None) -> None:
+        # Replaces the contents with all 64 squares at once, placing only the pieces, or taking the bitboards and
+        # totals from a state() saved from a board with the same squares
+        self.clear()
+        super().extend(squares)
+        if state:
+            pieces, occupied, self.occupancy, self.midgame, self.endgame, self.phase = state
+            self.pieces, self.occupied = dict(pieces), dict(occupied)
+        else:
+            for index, piece in enumerate(squares):
+                if piece.color != 'Empty':
+                    self.place(index, piece)
+
+    def state(self):
+        return dict(self.pieces), dict(self.occupied), self.occupancy, self.midgame, self.endgame, self.phase
+
+    def __setitem__(self, index: int, piece) -> None:
+        self.lift(index, self[index])
+        super().__setitem__(index, piece)
+        self.place(index, piece)
+
+    def is_square_attacked(self, square: int, by_color: str, occupancy = None) -> bool:
+        # Looks outwards from the square instead of generating enemy moves: the square is attacked by a knight
+        # if a knight on it would attack an enemy knight, and likewise for every other piece
+        # occupancy replaces the board's own, e.g. without the king to see the squares behind it
+        if occupancy is None:
+            occupancy = self.occupancy
+        pawn, knight, bishop, rook, queen, king = ATTACKERS[by_color]
+        pieces = self.pieces
+        if KNIGHT_ATTACKS[square] & pieces[knight] or KING_ATTACKS[square] & pieces[king]:
+            return True
+        # Pawns capture towards the opposite side, so look from the square as a pawn of the other color
+        if PAWN_ATTACKS['Black' if by_color == 'White' else 'White'][square] & pieces[pawn]:
+            return True
+        if rook_attacks(square, occupancy) & (pieces[rook] | pieces[queen]):
+            return True
+        return bishop_attacks(square, occupancy) & (pieces[bishop] | pieces[queen]) != 0
+
+    def attackers(self, square: int, by_color: str) -> int:
+        # Bitboard of the pieces of by_color attacking the square
+        pawn, knight, bishop, rook, queen, king = ATTACKERS[by_color]
+        pieces = self.pieces
+        return (KNIGHT_ATTACKS[square] & pieces[knight]
+                | KING_ATTACKS[square] & pieces[king]
+                | PAWN_ATTACKS['Black' if by_color == 'White' else 'White'][square] & pieces[pawn]
+                | rook_attacks(square, self.occupancy) & (pieces[rook] | pieces[queen])
+                | bishop_attacks(square, self.occupancy) & (pieces[bishop] | pieces[queen]))
+
+    def pins(self, king_square: int, color: str) -> dict:
+        # Maps the square of each piece of color pinned to its king to the squares it can still move to,
+        # the line from the king up to and including the pinning piece
+        pawn, knight, bishop, rook, queen, king = ATTACKERS['Black' if color == 'White' else 'White']
+        pinned = {}
+        for rays, sliders in ((ROOK_RAYS, self.pieces[rook] | self.pieces[queen]), (BISHOP_RAYS, self.pieces[bishop] | self.pieces[queen])):
+            for ray, increasing in rays:
+                if not ray[king_square] & sliders:
+                    continue
+                blockers = ray[king_square] & self.occupancy
+                first = nearest_square(blockers, increasing)
+                if not self.occupied[color] >> first & 1:
+                    continue
+                beyond = ray[first] & self.occupancy
+                if beyond:
+                    second = nearest_square(beyond, increasing)
+                    if sliders >> second & 1:
+                        pinned[first] = ray[king_square] ^ ray[second]
+        return pinned
 
 
 class Square:
+    # __slots__ in every piece class keeps instances free of a __dict__, a few hundred bytes less per piece
+    __slots__ = ('position', 'color', 'type_')
 
     def __init__(self, position: int, color = 'Empty', type_ = ' ') -> None:
         self.position = position # 0 to 63
@@ -29,8 +407,12 @@ class Square:
     def is_empty(self) -> bool:
         return self.color == "Empty"
 
-    def legal_moves(self):
-        return []
+    def targets(self, board) -> int:
+        # Bitboard of the squares the piece can move to by its ordinary moves
+        return 0
+
+    def legal_moves(self, board):
+        return bit_squares(self.targets(board))
 
     def print_legal_moves(self, legal):
         rev = []
@@ -38,8 +420,26 @@ class Square:
             rev.append(reverse_UCI_map[l])
         print('legal moves', rev)
 
+    def strictly_legal_moves(self, position):
+        # legal_moves() without the moves that would leave the own king in check
+        if position.turn != self.color:
+            return []
+        return list(dict.fromkeys(move_to for move_from, move_to, _ in position.generate_legal_moves() if move_from == self.position))
+
+    def move(self, position, move_to, promotion = None):
+        # promotion is 'q', 'r', 'n' or 'b' for a pawn reaching the last rank, a queen if left out
+        legal = self.strictly_legal_moves(position)
+
+        if move_to in legal:
+            position.make_move(self.position, move_to, promotion)
+
+        # ilegal move, let the caller try again
+        else:
+            raise IllegalMove(f'{reverse_UCI_map[self.position]}{reverse_UCI_map[move_to]} is not a legal move', legal)
+
 
 class Pawn(Square):
+    __slots__ = ('en_passant',)
 
     def __init__(self, position: int, color: str, type_: str, en_passant = False) -> None:
         super().__init__(position, color, type_)
@@ -48,158 +448,45 @@ class Pawn(Square):
     def is_empty(self) -> bool:
         return super().is_empty()
 
-    def legal_moves(self):
+    def targets(self, board) -> int:
+
+        empty = ~board.occupancy
 
-        legal = []
+        # Diagonal captures of enemy pieces from the precomputed attack table
+        targets = PAWN_ATTACKS[self.color][self.position] & board.occupancy & ~board.occupied[self.color]
 
         if self.color == 'White':
-            
-            one_step = self.position + 8
-            if one_step < 64 and BOARD[one_step].is_empty():
-                legal.append(one_step)
-
-            capture_right = self.position + 9
-            # Not in far right file 'h' and enemy piece in position
-            if self.position % 8 != 7 and BOARD[capture_right].is_empty() == False and BOARD[capture_right].color != self.color:
-                legal.append(capture_right)
-            
-            capture_left = self.position + 7
-            # Not in far left file 'a' and enemy piece in position
-            if self.position % 8 != 0 and BOARD[capture_left].is_empty() == False and BOARD[capture_left].color != self.color:
-                legal.append(capture_left)
 
-            two_steps = self.position + 16
-            if self.position in range(8, 16) and BOARD[two_steps].is_empty():
-                legal.append(two_steps)
+            one_step = 1 << (self.position + 8) & empty
+            if one_step:
+                targets |= one_step
+
+                # Two steps from the starting rank only when the path is clear
+                if self.position in range(8, 16):
+                    targets |= 1 << (self.position + 16) & empty
 
         if self.color == 'Black':
 
-            one_step = self.position - 8
-            if one_step >= 0 and BOARD[one_step].is_empty():
-                legal.append(one_step)
+            one_step = 1 << (self.position - 8) & empty
+            if one_step:
+                targets |= one_step
 
-            capture_right = self.position - 7
-            # Not in far right file 'h' and enemy piece in position
-            if self.position % 8 != 7 and BOARD[capture_right].is_empty() == False and BOARD[capture_right].color != self.color:
-                legal.append(capture_right)
+                if self.position in range(48, 56):
+                    targets |= 1 << (self.position - 16) & empty
+
+        return targets
+
+    def legal_moves(self, board):
+        legal = bit_squares(self.targets(board))
 
-            capture_left = self.position - 9
-            # Not in far left file 'a' and enemy piece in position
-            if self.position % 8 != 0 and BOARD[capture_left].is_empty() == False and BOARD[capture_left].color != self.color:
-                legal.append(capture_left)
-            
-            two_steps = self.position - 16
-            if self.position in range(48, 56) and BOARD[two_steps].is_empty():
-                legal.append(two_steps)
-                
         if self.en_passant:
             legal.append(self.en_passant)
 
         return legal
-        
-    def move(self, move_to, turn_color):
-        legal = self.legal_moves()
-
-        if move_to in legal:
-            
-            if self.color == 'White':
-
-                # Set en passant
-                if move_to == self.position + 16: # if 2 step move
-                    for side_pawn in [move_to - 1, move_to + 1]: # check for enemy neighboring pawns that could intercept en passant
-                        if side_pawn in range((move_to // 8) * 8, (move_to // 8) * 8 + 8) and BOARD[side_pawn].type_ == 'p':
-
-                            BOARD[side_pawn].en_passant = move_to - 8 # set interception position
-                            EN_PASSANT.append(BOARD[side_pawn]) # track pawns
-
-                    BOARD[self.position], BOARD[move_to] = Square(self.position), Pawn(move_to, self.color, self.type_)
-                
-                # Execute en passant
-                # if a pawn can move to an empty square diagonally
-                elif BOARD[move_to].is_empty() and (move_to == self.position + 7 or move_to == self.position + 9):
-                        BOARD[move_to - 8] = Square(move_to - 8)
-                        BOARD[self.position], BOARD[move_to] = Square(self.position), Pawn(move_to, self.color, self.type_)
-
-                # Promote if pawn reaches it's highest rank
-                elif move_to in range(56, 64):
-                    while True:
-                        try:
-                            promotion = input(f"Type 'Queen', 'Rook', 'Knight' or 'Bishop' to promote pawn at {reverse_UCI_map[move_to]}: ").lower()
-
-                            if promotion[:1] == 'q':
-                                BOARD[self.position], BOARD[move_to] = Square(self.position), Queen(move_to, self.color, 'Q')
-                                return
-                            elif promotion[:1] == 'r':
-                                BOARD[self.position], BOARD[move_to] = Square(self.position), Rook(move_to, self.color, 'R')
-                                return
-                            elif promotion[:1] == 'k':
-                                BOARD[self.position], BOARD[move_to] = Square(self.position), Knight(move_to, self.color, 'N')
-                                return
-                            elif promotion[:1] == 'b':
-                                BOARD[self.position], BOARD[move_to] = Square(self.position), Bishop(move_to, self.color, 'B')
-                                return
-                        except:
-                            pass
-                else:
-                    # Basic move
-                    BOARD[self.position], BOARD[move_to] = Square(self.position), Pawn(move_to, self.color, self.type_)
-
-            
-            elif self.color == 'Black':
-                        
-                # Set en passant
-                if move_to == self.position - 16: # if 2 step move
-                    for side_pawn in [move_to - 1, move_to + 1]: # check for enemy neighboring pawns that could intercept en passant
-                        if side_pawn in range((move_to // 8) * 8, (move_to // 8) * 8 + 8) and BOARD[side_pawn].type_ == 'P':
-
-                            BOARD[side_pawn].en_passant = move_to + 8 # set interception position
-                            EN_PASSANT.append(BOARD[side_pawn]) # track pawns
-                    # Basic move
-                    BOARD[self.position], BOARD[move_to] = Square(self.position), Pawn(move_to, self.color, self.type_)
-                
-                # Execute en passant
-                    # if a pawn can move to an empty square diagonally
-                elif BOARD[move_to].is_empty() and (move_to == self.position - 9 or move_to == self.position - 7):
-
-                        BOARD[move_to + 8] = Square(move_to + 8, 'Empty', ' ')
-                        # Basic move
-                        BOARD[self.position], BOARD[move_to] = Square(self.position), Pawn(move_to, self.color, self.type_)
-                
-                    # Promote if pawn reaches it's highest rank
-                elif move_to in range(0, 8):
-                    while True:
-                        try:
-                            promote_black = input(f"Type 'Queen', 'Rook', 'Knight' or 'Bishop' to promote pawn at {reverse_UCI_map[move_to]}: ").lower()
-                        
-                            if promote_black[:1] == 'q':
-                                BOARD[self.position], BOARD[move_to] = Square(self.position),Queen(move_to, self.color, 'q')
-                                return
-                            elif promote_black[:1] == 'k':
-                                BOARD[self.position], BOARD[move_to] = Square(self.position),Knight(move_to, self.color, 'n')
-                                return
-                            elif promote_black[:1] == 'r':
-                                BOARD[self.position], BOARD[move_to] = Square(self.position),Rook(move_to, self.color, 'r')
-                                return
-                            elif promote_black[:1] == 'b':
-                                BOARD[self.position], BOARD[move_to] = Square(self.position),Bishop(move_to, self.color, 'b')
-                                return
-                    
-                        except:
-                            pass
-
-                else:
-                    # Basic move
-                    BOARD[self.position], BOARD[move_to] = Square(self.position), Pawn(move_to, self.color, self.type_)      
-
-                
-            
-        # ilegal move, try again
-        else:
-            super().print_legal_moves(legal)
-            return player_input(turn_color)
 
 
 class King(Square):
+    __slots__ = ('can_castle',)
 
     def __init__(self, position: int, color: str, type_: str, can_castle = False) -> None:
         super().__init__(position, color, type_)
@@ -214,81 +501,38 @@ class King(Square):
         else:
             return 'White'
 
-    def check(self):
-        for enemy_piece in BOARD:
-            if self.enemy_color() == enemy_piece.color:
-                if self.position in enemy_piece.legal_moves():
-                    return True
-        return False
-
-    def legal_moves(self):
-        legal = []
+    def check(self, board):
+        return board.is_square_attacked(self.position, self.enemy_color())
 
-        top_left = self.position - 9
-        up = self.position - 8
-        top_right = self.position - 7
+    def targets(self, board) -> int:
+        return KING_ATTACKS[self.position] & ~board.occupied[self.color]
 
-        for sq in [top_left, up, top_right]:
-            if sq >= 0 and BOARD[sq].color != self.color and self.position // 8 == sq // 8 + 1:
-                legal.append(sq)
+    def legal_moves(self, board):
+        legal = bit_squares(self.targets(board))
 
-        bottom_left = self.position + 7
-        down = self.position + 8
-        bottom_right = self.position + 9
+        # Castling is not allowed out of check or through an attacked square, landing in check is left to the caller
+        if self.can_castle and not self.check(board):
 
-        for sq in [bottom_left, down, bottom_right]:
-            if sq < 64 and BOARD[sq].color != self.color and self.position // 8 + 1 == sq // 8:
-                legal.append(sq)
+            left_rook = board[(self.position // 8 * 8)] # object at index 0 or 56
+            right_rook = board[(self.position // 8 * 8 + 7)] # object at index 7 or 63
 
-        left = self.position - 1
-        right = self.position + 1
-
-        for sq in [left, right]:
-            if sq >= 0 and sq < 64 and self.color != BOARD[sq].color and self.position // 8 == sq // 8:
-                legal.append(sq)
-
-        if self.can_castle:
-
-            left_rook = BOARD[(self.position // 8 * 8)] # object at index 0 or 56
-            right_rook = BOARD[(self.position // 8 * 8 + 7)] # object at index 7 or 63
-
-            if left_rook.is_empty() == False:
+            # Only an unmoved rook of the king's own color can castle, Queen inherits can_castle = False from Rook
+            if isinstance(left_rook, Rook) and left_rook.can_castle and left_rook.color == self.color:
                     l, r = self.position - 2, self.position - 1
-                    if BOARD[l].is_empty() and BOARD[r].is_empty():
+                    if board[l].is_empty() and board[r].is_empty() and board[self.position - 3].is_empty() \
+                            and not board.is_square_attacked(r, self.enemy_color()):
                         legal.append(l)
             
-            if right_rook.is_empty() == False:
-                if right_rook.can_castle:
+            if isinstance(right_rook, Rook) and right_rook.can_castle and right_rook.color == self.color:
                     l, r = self.position + 1, self.position + 2
-                    if BOARD[l].is_empty() and BOARD[r].is_empty():
+                    if board[l].is_empty() and board[r].is_empty() and not board.is_square_attacked(l, self.enemy_color()):
                         legal.append(r)
                         
         return legal
 
-    def move(self, move_to, turn_color):
-        legal = self.legal_moves()
-
-        if move_to in legal:
-
-            # Castle left
-            if move_to == self.position - 2:
-                BOARD[move_to + 1], BOARD[self.position - 4] = Rook(move_to + 1, self.color, BOARD[self.position - 4].type_), Square(self.position - 4)
-
-            # Castle right
-            elif move_to == self.position + 2:
-                BOARD[move_to - 1], BOARD[self.position + 3] = Rook(move_to + 1, self.color, BOARD[self.position + 3].type_), Square(self.position + 3,)
-
-            BOARD[self.position], BOARD[move_to] = Square(self.position, 'Empty', ' '), King(move_to, self.color, self.type_)
-
-            KINGS[turn_color] = BOARD[move_to]
-
-        # ilegal move, try again
-        else:
-            super().print_legal_moves(legal)
-            return player_input(turn_color)
-
 
 class Knight(Square):
+    __slots__ = ()
 
     def __init__(self, position: int, color: str, type_: str) -> None:
         super().__init__(position, color, type_)
@@ -296,93 +540,13 @@ class Knight(Square):
     def is_empty(self) -> bool:
         return super().is_empty()
 
-    def legal_moves(self):
-        legal = []
-
-        up2_right1 = self.position - 15
-        up2_left1 = self.position - 17
-        
-        for up2 in [up2_right1, up2_left1]:
-            
-            # No up2 squares left
-            if self.position // 8 != up2 // 8 + 2:
-                continue
-            
-            if up2 >= 0:
-
-                # Prevent friendly fire
-                if BOARD[up2].color == self.color:
-                    continue
-
-                legal.append(up2)
-        
-        up1_right2 = self.position - 6
-        up1_left2 = self.position - 10
-
-        for up1 in[up1_right2, up1_left2]:
-
-            # No up1 squares left
-            if self.position // 8 != up1 // 8 + 1:
-                continue
-
-            if up1 >= 0:
-
-                # Prevent friendly fire
-                if BOARD[up1].color == self.color:
-                    continue
-
-                legal.append(up1)
-
-        down1_left2 = self.position + 6
-        down1_right2 = self.position +10
-
-        for down1 in [down1_left2, down1_right2]:
-
-            # No down1 squares left
-            if self.position // 8 != down1 // 8 - 1:
-                continue
-
-            if down1 < 64:
-
-                # Prevent friendly fire
-                if BOARD[down1].color == self.color:
-                    continue
-
-                legal.append(down1)
-
-        down2_left1 = self.position + 15
-        down2_right1 = self.position + 17
-
-        for down2 in [down2_left1, down2_right1]:
-
-            # No down2 squares left
-            if self.position // 8 != down2 // 8 - 2:
-                continue
-
-            if down2 < 64:
-
-                # Prevent friendly fire
-                if BOARD[down2].color == self.color:
-                    continue
-
-                legal.append(down2)
-
-        return legal
-    
-    def move(self, move_to, turn_color):
-        legal = self.legal_moves()
-
-        if move_to in legal:
-
-            BOARD[self.position], BOARD[move_to] = Square(self.position, 'Empty', ' '), Knight(move_to, self.color, self.type_)
-
-        # ilegal move, try again
-        else:
-            super().print_legal_moves(legal)
-            return player_input(turn_color)
+    def targets(self, board) -> int:
+        # Jumps from the precomputed table, minus squares taken by friendly pieces
+        return KNIGHT_ATTACKS[self.position] & ~board.occupied[self.color]
 
 
 class Rook(Square):
+    __slots__ = ('can_castle',)
 
     def __init__(self, position: int, color: str, type_: str, can_castle = False) -> None:
         super().__init__(position, color, type_)
@@ -391,57 +555,13 @@ class Rook(Square):
     def is_empty(self) -> bool:
         return super().is_empty()
 
-    def legal_moves(self):
-        legal = []
-
-        for up in range(self.position - 8, -1, -8):
-
-            if BOARD[up].color != self.color:
-                legal.append(up)
-            
-            if BOARD[up].is_empty() == False:
-                break
-
-        for down in range(self.position + 8, 64, 8):
-
-            if BOARD[down].color != self.color:
-                legal.append(down)
-            
-            if BOARD[down].is_empty() == False:
-                break
-
-        for left in range(self.position - 1, ((self.position//8) * 8) - 1, -1):
-            
-            if BOARD[left].color != self.color:
-                legal.append(left)
-
-            if BOARD[left].is_empty() == False:
-                break
-
-        for right in range(self.position + 1, (self.position//8) * 8 + 8):
-            
-            if BOARD[right].color != self.color:
-                legal.append(right)
-
-            if BOARD[right].is_empty() == False:
-                break
-
-        return legal
-
-    def move(self, move_to, turn_color):
-        legal = self.legal_moves()
-
-        if move_to in legal:
-
-            BOARD[self.position], BOARD[move_to] = Square(self.position, 'Empty', ' '), Rook(move_to, self.color, self.type_)
-
-        # ilegal move, try again
-        else:
-            super().print_legal_moves(legal)
-            return player_input(turn_color)
+    def targets(self, board) -> int:
+        # Files and ranks up to and including the first piece in each direction, minus friendly pieces
+        return rook_attacks(self.position, board.occupancy) & ~board.occupied[self.color]
 
 
 class Bishop(Square):
+    __slots__ = () # Must stay empty, Queen inherits from Rook too and only one base can add slots
 
     def __init__(self, position: int, color: str, type_: str) -> None:
         super().__init__(position, color, type_)
@@ -449,105 +569,13 @@ class Bishop(Square):
     def is_empty(self) -> bool:
         return super().is_empty()
 
-    def legal_moves(self):
-        legal = []
-        
-        prev_top_right = self.position
-        for top_right in range(self.position - 7, 0, - 7):
-            
-            # No top right square
-            if prev_top_right // 8 == top_right // 8:
-                break
-
-            # Prevent friendly fire
-            if BOARD[top_right].color == self.color:
-                break
-
-            legal.append(top_right)
-
-            # End path at obstruction
-            if BOARD[top_right].is_empty() == False:
-                break
-
-            # Update trailing variable
-            prev_top_right = top_right
-
-        prev_top_left = self.position
-        for top_left in range(self.position - 9, -1, - 9):
-            
-            # No top left square
-            if prev_top_left // 8 != top_left // 8 + 1:
-                break
-
-            # Prevent friendly fire
-            if BOARD[top_left].color == self.color:
-                break
-
-            legal.append(top_left)
-
-            # End path at obstruction
-            if BOARD[top_left].is_empty() == False:
-                break
-
-            # Update trailing variable
-            prev_top_left = top_left
-
-        prev_bottom_right = self.position
-        for bottom_right in range(self.position + 9, 64, 9):
-            
-            # No bottom right square
-            if prev_bottom_right // 8 + 1 != bottom_right // 8:
-                break
-
-            # Prevent friendly fire
-            if BOARD[bottom_right].color == self.color:
-                break
-
-            legal.append(bottom_right)
-
-            # End path at obstruction
-            if BOARD[bottom_right].is_empty() == False:
-                break
-            
-            # Update trailing variable
-            prev_bottom_right = bottom_right
-
-        prev_bottom_left = self.position
-        for bottom_left in range(self.position + 7, 64, 7):
-            
-            # No bottom left square
-            if prev_bottom_left // 8 == bottom_left // 8:
-                break
-
-            # Prevent friendly fire
-            if BOARD[bottom_left].color == self.color:
-                break
-
-            legal.append(bottom_left)
-
-            # End path at obstruction
-            if BOARD[bottom_left].is_empty() == False:
-                break
-
-            # Update trailing variable
-            prev_bottom_left = bottom_left
-
-        return legal
-
-    def move(self, move_to, turn_color):
-        legal = self.legal_moves()
-
-        if move_to in legal:
-
-            BOARD[self.position], BOARD[move_to] = Square(self.position, 'Empty', ' '), Bishop(move_to, self.color, self.type_)
-
-        # ilegal move, try again
-        else:
-            super().print_legal_moves(legal)
-            return player_input(turn_color)
+    def targets(self, board) -> int:
+        # Diagonals up to and including the first piece in each direction, minus friendly pieces
+        return bishop_attacks(self.position, board.occupancy) & ~board.occupied[self.color]
 
 
 class Queen(Rook, Bishop):
+    __slots__ = ()
 
     def __init__(self, position: int, color: str, type_: str) -> None:
         super().__init__(position, color, type_)
@@ -555,127 +583,953 @@ class Queen(Rook, Bishop):
     def is_empty(self) -> bool:
         return super().is_empty()
 
-    def legal_moves(self):
-        legal = []
-        legal.extend(Rook.legal_moves(self))
-        legal.extend(Bishop.legal_moves(self))
-        return(legal)
-
-    def move(self, move_to, turn_color):
-        legal = self.legal_moves()
-
-        if move_to in legal:
-
-            BOARD[self.position], BOARD[move_to] = Square(self.position, 'Empty', ' '), Queen(move_to, self.color, self.type_)
-
-        # ilegal move, try again
+    def targets(self, board) -> int:
+        return Rook.targets(self, board) | Bishop.targets(self, board)
+
+
+EMPTY_SQUARES = [Square(sq) for sq in range(64)] # Shared by every empty square so moves don't create new objects
+PROMOTIONS = {'q': Queen, 'r': Rook, 'n': Knight, 'b': Bishop}
+LIGHT_SQUARES = sum(1 << sq for sq in range(64) if (sq // 8 + sq % 8) % 2) # h1 is light, a1 dark
+PIECE_CLASSES = {'p': Pawn, 'n': Knight, 'b': Bishop, 'r': Rook, 'q': Queen, 'k': King}
+
+
+# Zobrist hashing: a position's key is the XOR of a random 64 bit number for each piece on its square, for the
+# castling rights, the en passant file and Black to move, so a move changes the key with a few XORs
+# A fixed seed gives the same keys in every process and every run
+ZOBRIST_RANDOM = random.Random(2022)
+ZOBRIST_PIECES = {type_: [ZOBRIST_RANDOM.getrandbits(64) for _ in range(64)] for type_ in 'PNBRQKpnbrqk'}
+ZOBRIST_BLACK = ZOBRIST_RANDOM.getrandbits(64)
+ZOBRIST_EN_PASSANT = [ZOBRIST_RANDOM.getrandbits(64) for _ in range(8)] # By file of the target square
+ZOBRIST_RIGHTS = [ZOBRIST_RANDOM.getrandbits(64) for _ in range(4)]
+ZOBRIST_CASTLING = [0] * 16 # Indexed by the castling rights bits, K = 1, Q = 2, k = 4, q = 8
+for rights in range(16):
+    for bit in range(4):
+        if rights >> bit & 1:
+            ZOBRIST_CASTLING[rights] ^= ZOBRIST_RIGHTS[bit]
+CASTLING = [('K', 4, 7), ('Q', 4, 0), ('k', 60, 63), ('q', 60, 56)] # Right, king square and rook square, in bit order
+CASTLING_SQUARES = {4, 7, 0, 60, 63, 56} # Castling rights only change when a move starts or ends on one of these
+MOVE_CACHE_BYTES = 8 << 20 # Rough size a Position's move cache may reach before it starts over
+MOVE_BYTES = sys.getsizeof((0, 0, None)) + 8 # A cached move tuple and its slot in the list
+
+
+class IllegalMove(Exception):
+
+    def __init__(self, message: str, legal = ()) -> None:
+        super().__init__(message)
+        self.legal = list(legal) # Legal destinations of the selected piece, helps users see what they can play
+
+
+class Position:
+    # A board with everything else needed to play on: kings, en passant pawns, the undo stack and the side to move
+    # Each position is independent, so any number of them can live side by side
+    __slots__ = ('board', 'kings', 'en_passant', 'undo', 'turn', 'halfmove_clock', 'fullmove_number', 'key', 'repetitions', 'move_cache',
+                 'move_cache_bytes', 'move_cache_hits', 'move_cache_misses')
+
+    def __init__(self) -> None:
+        self.board = Board() # 1d board that stores instances of Squares or Pieces
+        self.kings = {} # Tracks kings to make checks easier to compute
+        self.en_passant = [] # Tracks pawns capable of an en passant move, helps remove such capacity after one turn
+        self.undo = [] # Stack of records that let unmake_move take back moves made with make_move
+        self.turn = 'White'
+        self.halfmove_clock = 0 # Moves since the last capture or pawn move
+        self.fullmove_number = 1 # Starts at 1 and goes up after each Black move
+        self.key = 0 # Zobrist key, set once the board is filled and then updated by every move
+        self.repetitions = {} # Times each key has been reached, kept by make_move and unmake_move
+        self.move_cache = None # Legal moves by key, only while a Search has it on, see generate_legal_moves()
+        self.move_cache_bytes = 0
+        self.move_cache_hits = 0
+        self.move_cache_misses = 0
+
+    def initialize_board(self):
+        board = self.board
+        board.append(Rook(0, 'White', 'R', True)) # can_castle defaults to False, it is only set to true on start(when a piece has not moved)
+        board.append(Knight(1, 'White', 'N'))     # moving a king or rook sets can_castle back to False
+        board.append(Bishop(2, 'White', 'B'))
+        board.append(Queen(3, 'White', 'Q'))
+        board.append(King(4, 'White', 'K', True))
+        self.kings['White'] = board[4]
+        board.append(Bishop(5, 'White', 'B'))
+        board.append(Knight(6, 'White', 'N'))
+        board.append(Rook(7, 'White', 'R', True))
+        for sq in range(8, 16):
+            board.append(Pawn(sq, 'White', 'P'))
+        for sq in range(16, 48):
+            board.append(EMPTY_SQUARES[sq])
+        for sq in range(48, 56):
+            board.append(Pawn(sq, 'Black', 'p'))
+        board.append(Rook(56, 'Black', 'r', True))
+        board.append(Knight(57, 'Black', 'n'))
+        board.append(Bishop(58, 'Black', 'b'))
+        board.append(Queen(59, 'Black', 'q'))
+        board.append(King(60, 'Black', 'k', True))
+        self.kings['Black'] = board[60]
+        board.append(Bishop(61, 'Black', 'b'))
+        board.append(Knight(62, 'Black', 'n'))
+        board.append(Rook(63, 'Black', 'r', True))
+        self.key = self.zobrist_key()
+        self.repetitions = {self.key: 1}
+
+    @classmethod
+    def from_fen(cls, fen: str):
+        # Repeated FENs skip the parsing, the bitboards and the key, see fen_template()
+        fields, built = fen_template(fen)
+        position = cls.build(*fields, *built)
+        if position.kings['Black' if position.turn == 'White' else 'White'].check(position.board):
+            raise ValueError(f'{fen} leaves the king of the side not to move in check')
+        if built[0] is None:
+            built[:] = position.board.state(), position.key
+        return position
+
+    @classmethod
+    def build(cls, types, turn, rights, target, halfmove_clock, fullmove_number, state = None, key = None):
+        # Sets up a position from the type_ of each square (' ' when empty), the side to move, castling rights bits,
+        # the en passant target square or None, and the move counters
+        # state and key, from a position built from the same arguments, save working out the bitboards and the key
+        position = cls()
+        board = position.board
+        squares = [EMPTY_SQUARES[sq] if type_ == ' ' else PIECE_CLASSES[type_.lower()](sq, 'White' if type_.isupper() else 'Black', type_)
+                   for sq, type_ in enumerate(types)]
+        board.fill(squares, state)
+        for piece in squares:
+            if piece.type_ in 'Kk':
+                position.kings[piece.color] = piece
+
+        # Castling rights live on the unmoved king and rooks, a Queen is a Rook subclass so the type_ is compared
+        for bit, (right, king_sq, rook_sq) in enumerate(CASTLING):
+            if rights >> bit & 1 and board[king_sq].type_ == ('K' if right.isupper() else 'k') and board[rook_sq].type_ == ('R' if right.isupper() else 'r'):
+                board[king_sq].can_castle = True
+                board[rook_sq].can_castle = True
+
+        position.turn = turn
+        if target is not None:
+            pawn_square = target - 8 if turn == 'White' else target + 8 # square of the pawn that just moved 2 steps
+            for side_pawn in [pawn_square - 1, pawn_square + 1]:
+                if side_pawn // 8 == pawn_square // 8 and board[side_pawn].type_ == ('P' if turn == 'White' else 'p'):
+                    board[side_pawn].en_passant = target
+                    position.en_passant.append(board[side_pawn])
+        position.halfmove_clock, position.fullmove_number = halfmove_clock, fullmove_number
+        position.key = position.zobrist_key() if key is None else key
+        position.repetitions = {position.key: 1}
+        return position
+
+    def snapshot(self) -> bytes:
+        # The position packed in 70 bytes, the type_ of each square then side to move, castling rights, en passant
+        # target (255 for none), halfmove clock and a 2 byte fullmove number. A live Position takes a few kilobytes,
+        # so positions kept by the million are better stored like this and rebuilt with from_snapshot()
+        target = self.en_passant_target()
+        return (''.join(square.type_ for square in self.board).encode()
+                + bytes([self.turn == 'Black', self.castling_rights(), 255 if target is None else target, min(self.halfmove_clock, 255)])
+                + min(self.fullmove_number, 65535).to_bytes(2, 'little'))
+
+    @classmethod
+    def from_snapshot(cls, data: bytes):
+        return cls.build(data[:64].decode(), 'Black' if data[64] else 'White', data[65], None if data[66] == 255 else data[66],
+                         data[67], int.from_bytes(data[68:70], 'little'))
+
+    def castling_rights(self) -> int:
+        # Bits K = 1, Q = 2, k = 4, q = 8 of the castles still possible, an unmoved king and rook of the same color
+        board = self.board
+        rights = 0
+        for bit, (_, king_sq, rook_sq) in enumerate(CASTLING):
+            king, rook = board[king_sq], board[rook_sq]
+            if isinstance(king, King) and king.can_castle and type(rook) is Rook and rook.can_castle and rook.color == king.color:
+                rights |= 1 << bit
+        return rights
+
+    def en_passant_target(self):
+        # The en passant target square if the side to move has a pawn able to take there, None otherwise
+        for pawn in self.en_passant:
+            if pawn.color == self.turn and pawn.en_passant:
+                return pawn.en_passant
+        return None
+
+    def zobrist_key(self) -> int:
+        # Computes the key from scratch, make_move and unmake_move keep self.key equal to this without calling it
+        key = ZOBRIST_CASTLING[self.castling_rights()]
+        for sq, square in enumerate(self.board):
+            if not square.is_empty():
+                key ^= ZOBRIST_PIECES[square.type_][sq]
+        if self.turn == 'Black':
+            key ^= ZOBRIST_BLACK
+        target = self.en_passant_target()
+        if target is not None:
+            key ^= ZOBRIST_EN_PASSANT[target % 8]
+        return key
+
+    def to_fen(self) -> str:
+        board = self.board
+        rows = []
+        for rank in range(7, -1, -1): # FEN lists rank 8 first
+            row, empty = '', 0
+            for sq in range(rank * 8, rank * 8 + 8):
+                if board[sq].is_empty():
+                    empty += 1
+                else:
+                    row += (str(empty) if empty else '') + board[sq].type_
+                    empty = 0
+            rows.append(row + (str(empty) if empty else ''))
+
+        rights = self.castling_rights()
+        castling = ''.join(right for bit, (right, _, _) in enumerate(CASTLING) if rights >> bit & 1)
+
+        # Only pawns able to capture en passant are tracked, so the target is given when the capture is possible
+        target = self.en_passant_target()
+        en_passant = '-' if target is None else reverse_UCI_map[target]
+
+        return f"{'/'.join(rows)} {self.turn[0].lower()} {castling or '-'} {en_passant} {self.halfmove_clock} {self.fullmove_number}"
+
+    def in_check(self) -> bool:
+        return self.kings[self.turn].check(self.board)
+
+    def evaluate(self) -> int:
+        # Score in centipawns from the point of view of the side to move, read off the board's running totals
+        score = self.board.evaluate()
+        return score if self.turn == 'White' else -score
+
+    def make_move(self, move_from, move_to, promotion = None):
+        # Moves the piece in place and pushes everything needed to take the move back on the undo stack
+        board = self.board
+        piece = board[move_from]
+        captured = board[move_to]
+        capture_square = move_to
+        can_castle = getattr(piece, 'can_castle', False)
+        castle_rook = None
+        key = self.key
+        touches_castling = move_from in CASTLING_SQUARES or move_to in CASTLING_SQUARES
+        if touches_castling:
+            key ^= ZOBRIST_CASTLING[self.castling_rights()] # Taken out here and put back with the rights left after the move
+
+        # En passant, the captured pawn is beside the moving pawn rather than on the destination
+        if isinstance(piece, Pawn) and captured.is_empty() and move_to % 8 != move_from % 8:
+            capture_square = move_to - 8 if piece.color == 'White' else move_to + 8
+            captured = board[capture_square]
+            board[capture_square] = EMPTY_SQUARES[capture_square]
+        if not captured.is_empty():
+            key ^= ZOBRIST_PIECES[captured.type_][capture_square]
+
+        board[move_from] = EMPTY_SQUARES[move_from]
+        board[move_to] = piece
+        piece.position = move_to
+        if can_castle:
+            piece.can_castle = False
+
+        # Castling also moves the rook next to the king
+        if isinstance(piece, King) and abs(move_to - move_from) == 2:
+            rook_from = move_from - 4 if move_to < move_from else move_from + 3
+            rook_to = (move_from + move_to) // 2
+            castle_rook = board[rook_from]
+            board[rook_from] = EMPTY_SQUARES[rook_from]
+            board[rook_to] = castle_rook
+            castle_rook.position = rook_to
+            castle_rook.can_castle = False
+            key ^= ZOBRIST_PIECES[castle_rook.type_][rook_from] ^ ZOBRIST_PIECES[castle_rook.type_][rook_to]
+
+        if isinstance(piece, Pawn) and move_to // 8 in (0, 7):
+            promotion = promotion or 'q'
+            board[move_to] = PROMOTIONS[promotion](move_to, piece.color, promotion.upper() if piece.color == 'White' else promotion)
+        key ^= ZOBRIST_PIECES[piece.type_][move_from] ^ ZOBRIST_PIECES[board[move_to].type_][move_to]
+        if touches_castling:
+            key ^= ZOBRIST_CASTLING[self.castling_rights()]
+
+        # Pawns of the moving color lose their en passant chance, enemy pawns next to a 2 step move gain one
+        expired = [(pawn, pawn.en_passant) for pawn in self.en_passant if pawn.color == piece.color]
+        for pawn, _ in expired:
+            pawn.en_passant = False
+            self.en_passant.remove(pawn)
+        if expired:
+            key ^= ZOBRIST_EN_PASSANT[expired[0][1] % 8]
+
+        flagged = []
+        if isinstance(piece, Pawn) and abs(move_to - move_from) == 16:
+            for side_pawn in [move_to - 1, move_to + 1]:
+                if side_pawn // 8 == move_to // 8 and board[side_pawn].type_ == ('p' if piece.color == 'White' else 'P'):
+                    board[side_pawn].en_passant = (move_from + move_to) // 2 # set interception position
+                    self.en_passant.append(board[side_pawn])
+                    flagged.append(board[side_pawn])
+            if flagged:
+                key ^= ZOBRIST_EN_PASSANT[move_to % 8]
+
+        self.undo.append((move_from, move_to, piece, captured, capture_square, can_castle, castle_rook, expired, flagged, self.halfmove_clock, self.key))
+        self.key = key = key ^ ZOBRIST_BLACK
+        self.repetitions[key] = self.repetitions.get(key, 0) + 1
+        self.halfmove_clock = 0 if isinstance(piece, Pawn) or not captured.is_empty() else self.halfmove_clock + 1
+        if piece.color == 'Black':
+            self.fullmove_number += 1
+        self.turn = 'Black' if self.turn == 'White' else 'White'
+
+    def unmake_move(self):
+        # Takes back the last move made with make_move
+        repetitions = self.repetitions
+        if repetitions[self.key] == 1: # Keys only reached while searching don't pile up
+            del repetitions[self.key]
         else:
-            super().print_legal_moves(legal)
-            return player_input(turn_color)
-
-
-def initialize_board():
-    BOARD.append(Rook(0, 'White', 'R', True)) # can_castle defaults to False, it is only set to true on start(when a piece has not moved)
-    BOARD.append(Knight(1, 'White', 'N'))     # any move will create another instance on the board setting can_castle to its default value
-    BOARD.append(Bishop(2, 'White', 'B'))
-    BOARD.append(Queen(3, 'White', 'Q'))
-    BOARD.append(King(4, 'White', 'K', True))
-    KINGS['White'] = BOARD[4]
-    BOARD.append(Bishop(5, 'White', 'B'))
-    BOARD.append(Knight(6, 'White', 'N'))
-    BOARD.append(Rook(7, 'White', 'R', True))
-    for sq in range(8, 16):
-        BOARD.append(Pawn(sq, 'White', 'P'))
-    for sq in range(16, 48):
-        BOARD.append(Square(sq, 'Empty', ' '))
-    for sq in range(48, 56):
-        BOARD.append(Pawn(sq, 'Black', 'p'))
-    BOARD.append(Rook(56, 'Black', 'r', True))
-    BOARD.append(Knight(57, 'Black', 'n'))
-    BOARD.append(Bishop(58, 'Black', 'b'))
-    BOARD.append(Queen(59, 'Black', 'q'))
-    BOARD.append(King(60, 'Black', 'k', True))
-    KINGS['Black'] = BOARD[60]
-    BOARD.append(Bishop(61, 'Black', 'b'))
-    BOARD.append(Knight(62, 'Black', 'n'))
-    BOARD.append(Rook(63, 'Black', 'r', True))
-
-
-def display_board():
-
-    print('\n'*3) # clear screen
+            repetitions[self.key] -= 1
+        move_from, move_to, piece, captured, capture_square, can_castle, castle_rook, expired, flagged, self.halfmove_clock, self.key = self.undo.pop()
+        board = self.board
+        self.turn = piece.color
+        if piece.color == 'Black':
+            self.fullmove_number -= 1
+
+        for pawn in flagged:
+            pawn.en_passant = False
+            self.en_passant.remove(pawn)
+        for pawn, en_passant in expired:
+            pawn.en_passant = en_passant
+            self.en_passant.append(pawn)
+
+        if castle_rook:
+            rook_from = move_from - 4 if move_to < move_from else move_from + 3
+            board[castle_rook.position] = EMPTY_SQUARES[castle_rook.position]
+            board[rook_from] = castle_rook
+            castle_rook.position = rook_from
+            castle_rook.can_castle = True
+
+        # Puts back the pawn when the move was a promotion, and the captured piece where it was taken
+        board[move_to] = EMPTY_SQUARES[move_to]
+        board[capture_square] = captured
+        board[move_from] = piece
+        piece.position = move_from
+        if can_castle:
+            piece.can_castle = True
+
+    def generate_legal_moves(self):
+        # Every legal (move_from, move_to, promotion) for the side to move, a fresh list the caller can sort or change
+        # The key covers the pieces, side to move, castling rights and en passant, so a position reached again, by
+        # unmake_move() or another move order, takes its moves from the cache. Only a search comes back to positions
+        # often enough for that to pay, so the cache is off (None) unless a Search turns it on
+        if self.move_cache is None:
+            return self.find_legal_moves()
+        moves = self.move_cache.get(self.key)
+        if moves is not None:
+            self.move_cache_hits += 1
+            return moves[:]
+        self.move_cache_misses += 1
+        moves = self.find_legal_moves()
+        size = sys.getsizeof(moves) + len(moves) * MOVE_BYTES
+        if self.move_cache_bytes + size > MOVE_CACHE_BYTES:
+            self.move_cache.clear()
+            self.move_cache_bytes = 0
+        self.move_cache[self.key] = moves
+        self.move_cache_bytes += size
+        return moves[:]
+
+    def move_cache_stats(self) -> dict:
+        lookups = self.move_cache_hits + self.move_cache_misses
+        return {'hits': self.move_cache_hits, 'misses': self.move_cache_misses, 'hit rate': self.move_cache_hits / max(lookups, 1),
+                'positions': len(self.move_cache or ()), 'bytes': self.move_cache_bytes}
+
+    def find_legal_moves(self):
+        # The moves worked out from the board, checks and pins first so no move has to be played to find out
+        # whether it leaves the king in check
+        board = self.board
+        king = self.kings[self.turn]
+        enemy_color = king.enemy_color()
+        moves = []
+
+        # The king can go anywhere not attacked, looking through its current square for sliders it would still be in line with
+        without_king = board.occupancy & ~(1 << king.position)
+        for move_to in king.legal_moves(board):
+            if not board.is_square_attacked(move_to, enemy_color, without_king):
+                moves.append((king.position, move_to, None))
+
+        checkers = board.attackers(king.position, enemy_color)
+        if checkers & (checkers - 1): # Double check, only the king can move
+            return moves
+
+        # Out of check other pieces must capture the checking piece or block its path to the king
+        evasions = checkers | BETWEEN[king.position][checkers.bit_length() - 1] if checkers else -1
+        pins = board.pins(king.position, self.turn)
+
+        for move_from in bit_squares(board.occupied[self.turn] & ~(1 << king.position)):
+            piece = board[move_from]
+            targets = piece.targets(board) & evasions
+            if move_from in pins:
+                targets &= pins[move_from]
+
+            if not isinstance(piece, Pawn):
+                moves += [(move_from, move_to, None) for move_to in bit_squares(targets)]
+                continue
 
+            for move_to in bit_squares(targets):
+                if move_to // 8 in (0, 7):
+                    moves.extend((move_from, move_to, promotion) for promotion in 'qrbn')
+                else:
+                    moves.append((move_from, move_to, None))
+
+            move_to = piece.en_passant
+            if move_to:
+                # En passant takes a pawn off a different square, which masks miss, so try it on the board
+                self.make_move(move_from, move_to)
+                if not king.check(board):
+                    moves.append((move_from, move_to, None))
+                self.unmake_move()
+        return moves
+
+    def repetition_count(self) -> int:
+        # Times the current position has been reached, same pieces, side to move, castling rights and en passant
+        return self.repetitions.get(self.key, 0)
+
+    def insufficient_material(self) -> bool:
+        # Neither side can ever mate: no pawns, rooks or queens, and at most one knight or bishop (the board's running
+        # phase total) or only bishops all on squares of one color
+        board = self.board
+        pieces = board.pieces
+        if pieces['P'] | pieces['p'] | pieces['R'] | pieces['r'] | pieces['Q'] | pieces['q']:
+            return False
+        if board.phase <= 1:
+            return True
+        bishops = pieces['B'] | pieces['b']
+        return not (pieces['N'] | pieces['n']) and (bishops & LIGHT_SQUARES == bishops or not bishops & LIGHT_SQUARES)
+
+    def is_checkmate(self) -> bool:
+        return self.in_check() and not self.generate_legal_moves()
+
+    def is_stalemate(self) -> bool:
+        return not self.in_check() and not self.generate_legal_moves()
+
+    def perft(self, depth):
+        # Perft counts the leaf nodes of the legal move tree, comparing them with published counts verifies move generation
+        if depth == 0:
+            return 1
+
+        moves = self.find_legal_moves() # Past the move cache, so every node tests the generator itself
+        if depth == 1: # Every legal move is a leaf, no need to play them
+            return len(moves)
+
+        nodes = 0
+        for move_from, move_to, promotion in moves:
+            self.make_move(move_from, move_to, promotion)
+            nodes += self.perft(depth - 1)
+            self.unmake_move()
+        return nodes
+
+    def divide(self, depth):
+        # Node count below each root move, narrows a perft mismatch down to the move generating it
+        total = 0
+        for move_from, move_to, promotion in self.find_legal_moves():
+            self.make_move(move_from, move_to, promotion)
+            nodes = self.perft(depth - 1)
+            total += nodes
+            print(f'{reverse_UCI_map[move_from]}{reverse_UCI_map[move_to]}{promotion or ""}: {nodes}')
+            self.unmake_move()
+        print('total', total)
+        return total
+
+
+@lru_cache(maxsize=1024)
+def fen_template(fen: str):
+    # Parses a FEN into Position.build() arguments, with a [state, key] list that from_fen() fills in with the
+    # bitboards and key of the first position built from it. The most recent 1024 FENs are remembered
+    # (fen_template.cache_info() has the hits and misses)
+    # Anything that can't be played on raises ValueError, so callers only have one exception to catch
+    fields = fen.split()
+    if len(fields) not in (4, 6):
+        raise ValueError(f'{fen!r} is not a FEN, it needs 4 or 6 fields')
+    placement, turn, castling, en_passant, *counters = fields
+    rows = placement.split('/')
+    if len(rows) != 8:
+        raise ValueError(f'{placement} does not have 8 ranks')
+    types = ''
+    for row in reversed(rows): # FEN lists rank 8 first
+        squares = ''
+        for char in row:
+            if char in '12345678':
+                squares += ' ' * int(char)
+            elif char in 'PNBRQKpnbrqk':
+                squares += char
+            else:
+                raise ValueError(f'{char!r} in {placement} is not a piece')
+        if len(squares) != 8:
+            raise ValueError(f'{row} in {placement} is not 8 squares')
+        types += squares
+    if types.count('K') != 1 or types.count('k') != 1:
+        raise ValueError(f'{placement} needs exactly one king of each color')
+    if set(types[:8] + types[56:]) & set('Pp'):
+        raise ValueError(f'{placement} has a pawn on the first or last rank')
+    if turn not in ('w', 'b'):
+        raise ValueError(f'{turn} is not a side to move')
+    if en_passant != '-':
+        # The target is the square a pawn of the side not to move just skipped, so that pawn stands beyond it and
+        # the square it came from is empty
+        target = UCI_map.get(en_passant)
+        ahead = 8 if turn == 'w' else -8 # From the target towards the pushed pawn's starting square
+        if (target is None or target // 8 != (5 if turn == 'w' else 2) or types[target] != ' ' or types[target + ahead] != ' '
+                or types[target - ahead] != ('p' if turn == 'w' else 'P')):
+            raise ValueError(f'{en_passant} is not an en passant square')
+    if counters and not all(counter.isdigit() for counter in counters):
+        raise ValueError(f'{" ".join(counters)} are not move counters')
+    rights = sum(1 << bit for bit, (right, _, _) in enumerate(CASTLING) if right in castling)
+    target = None if en_passant == '-' else UCI_map[en_passant]
+    halfmove_clock, fullmove_number = (int(counters[0]), int(counters[1])) if counters else (0, 1)
+    return (types, 'White' if turn == 'w' else 'Black', rights, target, halfmove_clock, fullmove_number), [None, None]
+
+
+class Game:
+    # A game fed with UCI moves, with no input, output or waiting so it can be embedded or run many times over
+
+    def __init__(self, fen = None, claim_draws = False) -> None:
+        if fen:
+            self.position = Position.from_fen(fen)
+        else:
+            self.position = Position()
+            self.position.initialize_board()
+        self.moves = [] # UCI moves played so far
+        self.result = None # '1-0', '0-1' or '1/2-1/2' once the game is over
+        self.reason = None # 'checkmate', 'stalemate', 'resignation' or one of the draws in draw_reason()
+        self.claim_draws = claim_draws # Ends the game on threefold repetition and the fifty move rule as if claimed
+        self.legal_moves = self.position.generate_legal_moves() # Kept for the side to move, checks the next move and the end of the game
+        self.check_end() # A FEN can start the game already over
+
+    def play(self, uci):
+        # Plays a move such as 'e2e4' or 'e7e8q' and returns the result if it ended the game,
+        # an illegal move raises IllegalMove and leaves the game as it was
+        if self.result:
+            raise IllegalMove('the game is over')
+        if uci[:2] not in UCI_map or uci[2:4] not in UCI_map or uci[4:] not in ('', 'q', 'r', 'b', 'n'):
+            raise IllegalMove(f'{uci} is not a move in UCI format')
+        move_from, move_to, promotion = UCI_map[uci[:2]], UCI_map[uci[2:4]], uci[4:] or None
+        piece = self.position.board[move_from]
+        if piece.color != self.position.turn:
+            raise IllegalMove(f'there is no {self.position.turn} piece on {uci[:2]}')
+        if promotion is None and isinstance(piece, Pawn) and move_to // 8 in (0, 7):
+            promotion = 'q'
+
+        if (move_from, move_to, promotion) not in self.legal_moves:
+            legal = dict.fromkeys(to for frm, to, _ in self.legal_moves if frm == move_from)
+            raise IllegalMove(f'{uci} is not a legal move', legal)
+        self.position.make_move(move_from, move_to, promotion)
+        self.moves.append(uci)
+
+        self.legal_moves = self.position.generate_legal_moves()
+        self.check_end()
+        return self.result
+
+    def check_end(self) -> None:
+        # Sets the result when the side to move has no legal moves or the position is a draw
+        if not self.legal_moves:
+            if self.position.in_check():
+                self.result, self.reason = ('1-0' if self.position.turn == 'Black' else '0-1'), 'checkmate'
+            else:
+                self.result, self.reason = '1/2-1/2', 'stalemate'
+        else:
+            reason = self.draw_reason()
+            if reason:
+                self.result, self.reason = '1/2-1/2', reason
+
+    def draw_reason(self):
+        # The draw the position has reached, if any. Fivefold repetition, the seventy-five move rule and insufficient
+        # material end a game by themselves, threefold repetition and the fifty move rule only when claimed. All of
+        # them read a counter kept as the moves are made, the board and the move list are never gone through again
+        position = self.position
+        repetitions = position.repetition_count()
+        if repetitions >= 5:
+            return 'fivefold repetition'
+        if position.halfmove_clock >= 150:
+            return 'seventy-five move rule'
+        if position.insufficient_material():
+            return 'insufficient material'
+        if self.claim_draws and repetitions >= 3:
+            return 'threefold repetition'
+        if self.claim_draws and position.halfmove_clock >= 100:
+            return 'fifty move rule'
+        return None
+
+    def resign(self, color):
+        self.result, self.reason = ('0-1' if color == 'White' else '1-0'), 'resignation'
+        return self.result
+
+
+PERFT_POSITIONS = [
+    ('Start position', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1', [20, 400, 8902, 197281, 4865609]),
+    ('Kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1', [48, 2039, 97862, 4085603]),
+    ('Position 3', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1', [14, 191, 2812, 43238, 674624]),
+    ('Position 4', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1', [6, 264, 9467, 422333]),
+    ('Position 5', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8', [44, 1486, 62379, 2103487]),
+]
+
+FEN_CHECKS = [ # FEN and how to_fen() writes it back, None when it has to raise ValueError
+    ('4k3/8/8/8/8/8/8/Q3K3 w Q - 0 1', '4k3/8/8/8/8/8/8/Q3K3 w - - 0 1'), # A queen on a1 can't castle
+    ('4k3/8/8/8/8/8/3P4/4K3 w - e3 0 1', None), # No black pawn skipped e3
+    ('4k3/4Q3/8/8/8/8/8/4K3 w - - 0 1', None), # White could take the king
+]
+
+
+def run_perft(max_depth):
+    # Checks every position in PERFT_POSITIONS up to max_depth and reports nodes per second for each depth
+    passed = True
+    for name, fen, expected in PERFT_POSITIONS:
+        for depth in range(1, min(max_depth, len(expected)) + 1):
+            position = Position.from_fen(fen)
+            start = perf_counter()
+            nodes = position.perft(depth)
+            elapsed = perf_counter() - start
+            status = 'OK' if nodes == expected[depth - 1] else f'MISMATCH (expected {expected[depth - 1]})'
+            passed = passed and nodes == expected[depth - 1]
+            print(f'{name} depth {depth}: {nodes} nodes in {elapsed:.3f}s, {nodes / elapsed:.0f} nodes/s {status}')
+    for fen, expected in FEN_CHECKS:
+        try:
+            written = Position.from_fen(fen).to_fen()
+        except ValueError:
+            written = None
+        status = 'OK' if written == expected else f'MISMATCH (expected {expected or "rejected"})'
+        passed = passed and written == expected
+        print(f'FEN {fen}: {written or "rejected"} {status}')
+    return passed
+
+
+def memory_benchmark(count = 10000):
+    # Bytes taken by each stored position as a live Position, as a snapshot() and as a FEN string
+    rng = random.Random(0)
+    fens = []
+    while len(fens) < count:
+        game = Game()
+        for _ in range(rng.randrange(1, 80)):
+            if game.result:
+                break
+            move_from, move_to, promotion = rng.choice(game.legal_moves)
+            game.play(f'{reverse_UCI_map[move_from]}{reverse_UCI_map[move_to]}{promotion or ""}')
+        fens.append(game.position.to_fen())
+
+    def parse(fen):
+        # Past the FEN cache, whose entries made while measuring would otherwise count as position memory
+        return Position.build(*fen_template.__wrapped__(fen)[0])
+
+    for name, build in [('Position', parse), ('snapshot()', lambda fen: parse(fen).snapshot()),
+                        ('FEN string', lambda fen: ''.join(fen))]:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        stored = [build(fen) for fen in fens]
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        print(f'{name}: {used / count:.0f} bytes per position')
+        del stored
+
+
+UCI_MOVE = re.compile(r'[a-h][1-8][a-h][1-8][qrbn]?$')
+
+
+def read_games(lines):
+    # Yields (name, moves) for each game in a move list like chess_demo.txt: one UCI move per line, games are
+    # separated by blank lines or by a header line, the last header before a game names it
+    name, moves = None, []
+    for line in lines:
+        text = line.strip()
+        if UCI_MOVE.match(text.lower()):
+            moves.append(text.lower())
+            continue
+        if moves:
+            yield name, moves
+            name, moves = None, []
+        if text:
+            name = text
+    if moves:
+        yield name, moves
+
+
+def replay(name, moves):
+    # Plays a game's moves without any output or waiting, returns a line with the result and final position
+    game = Game()
+    for ply, uci in enumerate(moves, 1):
+        try:
+            game.play(uci)
+        except IllegalMove as error:
+            return False, f'{name}: illegal move {uci} at ply {ply} ({error}), {game.position.to_fen()}'
+    return True, f'{name}: {len(moves)} moves, {game.result or "*"} {game.reason or "unfinished"}, {game.position.to_fen()}'
+
+
+def replay_files(paths):
+    # Streams every game of every file through replay() and reports the overall throughput on stderr
+    games = plies = 0
+    all_legal = True
+    start = perf_counter()
+    for path in paths:
+        with open(path) as file:
+            for name, moves in read_games(file):
+                games += 1
+                plies += len(moves)
+                legal, line = replay(name or f'{path} game {games}', moves)
+                all_legal = all_legal and legal
+                print(line)
+    elapsed = perf_counter() - start
+    print(f'{games} games, {plies} moves in {elapsed:.3f}s, {plies / max(elapsed, 1e-9):.0f} moves/s', file=sys.stderr)
+    return all_legal
+
+
+def show_files(paths, fps = None):
+    # Plays the games of move list files on the screen as fast as the terminal takes them, or at most fps frames a
+    # second, for watching games between programs
+    renderer = BoardRenderer(fps=fps)
+    start = perf_counter()
+    try:
+        for path in paths:
+            with open(path) as file:
+                for name, moves in read_games(file):
+                    game = Game()
+                    display_board(game.position.board, renderer)
+                    for uci in moves:
+                        try:
+                            game.play(uci)
+                        except IllegalMove as error:
+                            renderer.flush() # The last board a throttled renderer held back comes before the message
+                            print(f'{name or path}: illegal move {uci} ({error})')
+                            break
+                        display_board(game.position.board, renderer)
+                    else:
+                        renderer.flush()
+                        print(f'{name or path}: {game.result or "*"} {game.reason or "unfinished"}')
+    finally:
+        renderer.close()
+    elapsed = perf_counter() - start
+    print(f'{renderer.frames} boards drawn in {elapsed:.2f}s', file=sys.stderr)
+
+
+def replay_batch(games):
+    # Runs in a worker process, replays a batch of (name, moves) games and returns their replay() results in order
+    return [replay(name, moves) for name, moves in games]
+
+
+def batches(paths, batch_moves = 2000):
+    # Groups the games of all files into batches of about batch_moves moves, few enough messages to the
+    # workers to keep them busy but small enough to keep memory bounded and progress frequent
+    batch, size, games = [], 0, 0
+    for path in paths:
+        with open(path) as file:
+            for name, moves in read_games(file):
+                games += 1
+                batch.append((name or f'{path} game {games}', moves))
+                size += len(moves)
+                if size >= batch_moves:
+                    yield batch, size
+                    batch, size = [], 0
+    if batch:
+        yield batch, size
+
+
+def validate_files(paths, workers = None):
+    # Same output as replay_files but the games are replayed by a pool of processes, one per core by default.
+    # Results are printed in input order, and only a few batches per worker are in flight at any time
+    workers = workers or os.cpu_count() or 1
+    games = plies = illegal = 0
+    start = last_report = perf_counter()
+    pending = deque()
+
+    def report(batch_results, size):
+        nonlocal games, plies, illegal, last_report
+        for legal, line in batch_results:
+            illegal += not legal
+            print(line)
+        games += len(batch_results)
+        plies += size
+        if perf_counter() - last_report >= 1: # Progress at most once a second
+            last_report = perf_counter()
+            print(f'{games} games, {plies} moves, {plies / (last_report - start):.0f} moves/s', file=sys.stderr)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for batch, size in batches(paths):
+            pending.append((executor.submit(replay_batch, batch), size))
+            if len(pending) >= workers * 4:
+                future, done_size = pending.popleft()
+                report(future.result(), done_size)
+        while pending:
+            future, done_size = pending.popleft()
+            report(future.result(), done_size)
+
+    elapsed = perf_counter() - start
+    print(f'{games} games ({illegal} with illegal moves), {plies} moves in {elapsed:.3f}s with {workers} workers, '
+          f'{plies / max(elapsed, 1e-9):.0f} moves/s', file=sys.stderr)
+    return illegal == 0
+
+
+def board_lines(types):
+    # The board as text, a line per rank with the type_ of each square between bars, rank 1 at the top
     files = '   |' # columns header
     for letter in LETTERS:
         files += f' {letter} |'
-    print(files)
-
+    lines = [files]
     for rank in range(1, 9): # rows
         ranks = f' {rank} |'
         for sq in range(rank * 8 - 8, rank * 8):
-            ranks += f' {BOARD[sq].type_} |'
-        print('------------------------------------')
-        print(ranks)
-    print('   ---------------------------------')
-    print('\n'*3)
+            ranks += f' {types[sq]} |'
+        lines.append('------------------------------------')
+        lines.append(ranks)
+    lines.append('   ---------------------------------')
+    return lines
 
 
-def player_input(turn_color, checked = False):
+# Where the board sits on an ANSI screen, 1 based: square sq is on line 3 + 2 * (sq // 8), column 6 + 4 * (sq % 8)
+BOARD_HEIGHT = 18
+TEXT_TOP = BOARD_HEIGHT + 2 # Prompts and messages scroll below the board from this line
 
-    while True:
-        try:
-            
-            input_text = input(f"{turn_color} player's move: ").lower()
-            if input_text == 'resign':
-                print(KINGS[turn_color].enemy_color(), 'Wins!')
-                break
 
-            selected_piece = BOARD[UCI_map[input_text[:2]]]
-
-            if turn_color == selected_piece.color:
-                
-                move_to = BOARD[UCI_map[input_text[-2:]]].position
-                
-                selected_piece.move(move_to, turn_color)
-
-                display_board()
-
-                sleep(1.25) # Allows Demo using copy + paste from a list of moves 
-
-                # Check helpers
-                own_king = KINGS[turn_color]
-                enemy_king = KINGS[own_king.enemy_color()]
-                
-                # Checkmate
-                if own_king.check():
-                    if checked:
-                        print('Checkmate!')
-                        sleep(1)
-                        print(enemy_king.color, 'wins!')
-                        break
-                    return player_input(turn_color)
-
-                # Check
-                if enemy_king.check():
-                    print('Check!')
-                    sleep(1)
-                    return player_input(enemy_king.color, checked = True)
-
-                # Ensure pawns are only capable of an en passant move for a single turn
-                for pawn in EN_PASSANT:
-                    if pawn.color == turn_color:
-                        pawn.en_passant = False
-                        EN_PASSANT.remove(pawn)
-
-                if turn_color == 'White':
-                    return player_input('Black')
-                else:
-                    return player_input('White')
+def supports_ansi(stream) -> bool:
+    # Cursor movement is only sent to terminals known to understand it, files, pipes and dumb terminals get plain text
+    if not hasattr(stream, 'isatty') or not stream.isatty() or os.environ.get('TERM') == 'dumb':
+        return False
+    if os.name == 'nt' and 'WT_SESSION' not in os.environ: # Only Windows Terminal is sure to take escape codes
+        return False
+    return shutil.get_terminal_size().lines > TEXT_TOP + 2
+
+
+class BoardRenderer:
+    # Draws boards for display_board(), each frame is built as one string and written at once
+    # On an ANSI terminal the first frame clears the screen and pins the board to the top, with a scrolling region for
+    # the text below, and later frames only rewrite the squares that changed. Otherwise every frame is the whole board
+    # in plain text. With fps, frames coming faster than that are dropped, flush() draws the last one
+
+    def __init__(self, stream = None, ansi = None, fps = None) -> None:
+        self.stream = stream or sys.stdout
+        self.ansi = supports_ansi(self.stream) if ansi is None else ansi
+        self.interval = 1 / fps if fps else 0
+        self.drawn = None # type_ of each square as on screen, None until the first ANSI frame
+        self.pending = None # Squares of the last dropped frame
+        self.last_frame = 0
+        self.frames = 0 # Frames written
+
+    def draw(self, board, force = False) -> bool:
+        # Returns whether the board was written, False when the frame rate dropped it
+        types = [square.type_ for square in board]
+        if self.interval and not force and perf_counter() - self.last_frame < self.interval:
+            self.pending = types
+            return False
+        self.write(types)
+        return True
+
+    def flush(self) -> None:
+        if self.pending:
+            self.write(self.pending)
+
+    def write(self, types) -> None:
+        self.pending = None
+        self.last_frame = perf_counter()
+        self.frames += 1
+        self.stream.write(self.frame(types))
+        self.stream.flush()
+
+    def frame(self, types) -> str:
+        if not self.ansi:
+            return '\n' * 4 + '\n'.join(board_lines(types)) + '\n' * 5 # Blank lines push the last board up
+        if self.drawn is None:
+            text = '\x1b[2J\x1b[H' + '\n'.join(board_lines(types))
+            text += f'\x1b[{TEXT_TOP};{shutil.get_terminal_size().lines}r' # Scrolling region
+        else:
+            text = ''.join(f'\x1b[{3 + 2 * (sq // 8)};{6 + 4 * (sq % 8)}H{type_}'
+                           for sq, (type_, drawn) in enumerate(zip(types, self.drawn)) if type_ != drawn)
+        self.drawn = types
+        return text + f'\x1b[{TEXT_TOP};1H\x1b[J' # Text starts again right below the board
+
+    def close(self) -> None:
+        # Gives the whole screen back to the terminal
+        self.flush()
+        if self.ansi and self.drawn is not None:
+            self.stream.write('\x1b[r\x1b[999;1H\n')
+            self.stream.flush()
+            self.drawn = None
+
+
+def display_board(board, renderer = None):
+    # Without a renderer the board is written in plain text, a renderer kept across moves only redraws what changed
+    return (renderer or BoardRenderer(ansi=False)).draw(board)
+
 
-        except:
-            pass
+def player_input(game, renderer = None):
+    # One pass of the loop per typed move, retries and checks included, so the stack stays flat however long the game
 
-# Run the game
-initialize_board()
-display_board()
-player_input('White')
+    while game.result is None:
+
+        turn_color = game.position.turn
+        try:
+            input_text = input(f"{turn_color} player's move: ").lower()
+        except EOFError: # No more input, e.g. the end of a pasted list of moves
+            break
+
+        if input_text == 'resign':
+            game.resign(turn_color)
+            print(game.position.kings[turn_color].enemy_color(), 'Wins!')
+            break
+
+        # Ignore anything that is not a move of one of the player's own pieces
+        if input_text[:2] not in UCI_map or input_text[2:4] not in UCI_map:
+            continue
+        selected_piece = game.position.board[UCI_map[input_text[:2]]]
+        if turn_color != selected_piece.color:
+            continue
+
+        move_to = UCI_map[input_text[2:4]]
+        promotion = input_text[4:5] or None
+
+        # Promote if pawn reaches it's highest rank, asking for the piece if it was not typed after the move
+        if isinstance(selected_piece, Pawn) and move_to // 8 in (0, 7) and promotion is None \
+                and move_to in selected_piece.strictly_legal_moves(game.position):
+            while promotion is None or promotion[:1] not in ('q', 'r', 'k', 'n', 'b'):
+                try:
+                    promotion = input(f"Type 'Queen', 'Rook', 'Knight' or 'Bishop' to promote pawn at {reverse_UCI_map[move_to]}: ").lower()
+                except EOFError: # The input ended on the pawn move, like the main prompt the game just stops
+                    return
+            promotion = 'n' if promotion[:1] == 'k' else promotion[:1]
+
+        try:
+            game.play(input_text[:4] + (promotion or ''))
+        # ilegal move, try again
+        except IllegalMove as error:
+            selected_piece.print_legal_moves(error.legal)
+            continue
+
+        display_board(game.position.board, renderer)
+
+        sleep(1.25) # Allows Demo using copy + paste from a list of moves 
+
+        if game.reason == 'checkmate':
+            print('Checkmate!')
+            sleep(1)
+            print(turn_color, 'wins!')
+
+        elif game.result == '1/2-1/2': # Stalemate, repetition, the move rules or insufficient material
+            print(f'{game.reason.capitalize()}!')
+            sleep(1)
+            print('Draw')
+
+        # Check
+        elif game.position.in_check():
+            print('Check!')
+            sleep(1)
+
+
+def main(args):
+    # 'perft [depth]' and 'divide depth [fen]' check move generation, 'replay file...' checks move lists and
+    # 'validate [--workers n] file...' does it on every core, 'memory [count]' measures the size of stored positions,
+    # 'show [--fps n] file...' plays move lists on the screen, no arguments plays a game in the terminal
+    if args[:1] == ['replay']:
+        return 0 if replay_files(args[1:]) else 1
+    if args[:1] == ['validate']:
+        workers = None
+        if args[1:2] == ['--workers']:
+            workers, args = int(args[2]), args[2:]
+        return 0 if validate_files(args[1:], workers) else 1
+    if args[:1] == ['perft']:
+        return 0 if run_perft(int(args[1]) if len(args) > 1 else 3) else 1
+    if args[:1] == ['memory']:
+        memory_benchmark(int(args[1]) if len(args) > 1 else 10000)
+        return 0
+    if args[:1] == ['divide']:
+        Position.from_fen(args[2] if len(args) > 2 else PERFT_POSITIONS[0][1]).divide(int(args[1]))
+        return 0
+
+    if args[:1] == ['show']:
+        fps = None
+        if args[1:2] == ['--fps']:
+            fps, args = float(args[2]), args[2:]
+        show_files(args[1:], fps)
+        return 0
+
+    game = Game(claim_draws=True) # Draws that need a claim are taken as soon as they are due
+    renderer = BoardRenderer()
+    display_board(game.position.board, renderer)
+    try:
+        player_input(game, renderer)
+    finally:
+        renderer.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
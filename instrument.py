@@ -0,0 +1,161 @@
+"""
+Opt-in instrumentation for chess.py: calls and time spent in the hot paths, moves per second and piece allocations
+"""
+
+import json
+import sys
+import threading
+from time import perf_counter
+
+import chess
+
+# Wrapped only while instrumentation is on, chess.py itself has no hooks, so switched off it costs nothing at all
+# Methods are wrapped on every class that defines them, the name a call is counted under is the class of the object
+HOT_METHODS = ('legal_moves', 'targets', 'move', 'check')
+POSITION_METHODS = ('make_move', 'unmake_move', 'generate_legal_moves', 'find_legal_moves')
+FUNCTIONS = ('display_board', 'fen_template') # Module functions, looked up by name when called so they can be swapped
+
+
+class Stats:
+    # Everything counted while instrumentation is on, report() gives it as a dict
+
+    def __init__(self) -> None:
+        self.calls = {} # 'Class.method' or function name: number of calls
+        self.seconds = {} # Same keys, time spent inside, nested calls of the same name counted once
+        self.allocations = {} # Class name: Square and piece objects created
+        self.started = perf_counter()
+
+    def count(self, name, elapsed) -> None:
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.seconds[name] = self.seconds.get(name, 0) + elapsed
+
+    def report(self) -> dict:
+        elapsed = perf_counter() - self.started
+        # Copies first, the counts go on changing while a dump thread reads them
+        calls, seconds, allocations = dict(self.calls), dict(self.seconds), dict(self.allocations)
+        moves = calls.get('Position.make_move', 0)
+        created = sum(allocations.values())
+        return {
+            'seconds': elapsed,
+            'moves': moves, # Every make_move(), in games, searches and perft alike
+            'moves per second': moves / elapsed if elapsed else 0,
+            'allocations': allocations,
+            'allocations per move': created / moves if moves else 0,
+            'calls': {name: {'calls': count, 'seconds': seconds[name], 'microseconds per call': seconds[name] / count * 1e6}
+                      for name, count in sorted(calls.items(), key=lambda item: -seconds[item[0]])},
+        }
+
+    def format(self) -> str:
+        report = self.report()
+        lines = [f"{report['seconds']:.1f}s, {report['moves']} moves, {report['moves per second']:.0f} moves/s, "
+                 f"{report['allocations per move']:.2f} pieces created per move {report['allocations']}"]
+        for name, call in report['calls'].items():
+            lines.append(f"  {name:<36} {call['calls']:>10} calls {call['seconds']:>9.3f}s {call['microseconds per call']:>9.2f}us/call")
+        return '\n'.join(lines)
+
+
+STATS = None # The Stats being filled, None while instrumentation is off
+ORIGINALS = [] # (owner, attribute, original) for everything wrapped, put back by disable()
+
+
+def timed(stats, owner, attribute, function):
+    # Times a call under the name of the object's class (or the function's), a call made from inside another of the
+    # same name, like Queen.targets() calling Rook.targets(), is only part of the outer one
+    active = set()
+    is_method = isinstance(owner, type)
+
+    def wrapper(*args, **kwargs):
+        name = f'{type(args[0]).__name__}.{attribute}' if is_method else attribute
+        if name in active:
+            return function(*args, **kwargs)
+        active.add(name)
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats.count(name, perf_counter() - start)
+            active.discard(name)
+    wrapper.__wrapped__ = function
+    return wrapper
+
+
+def counted(stats, function):
+    # Counts Square and piece objects as they are made, Square.__init__ runs once for every one of them
+    def wrapper(self, *args, **kwargs):
+        name = type(self).__name__
+        stats.allocations[name] = stats.allocations.get(name, 0) + 1
+        return function(self, *args, **kwargs)
+    wrapper.__wrapped__ = function
+    return wrapper
+
+
+def replace(owner, attribute, wrapper) -> None:
+    ORIGINALS.append((owner, attribute, vars(owner)[attribute]))
+    setattr(owner, attribute, wrapper)
+
+
+def enable() -> Stats:
+    # Starts counting into a new Stats, which is returned and also kept in STATS
+    global STATS
+    if STATS is not None:
+        return STATS
+    STATS = stats = Stats()
+    for cls in [chess.Square, *chess.PIECE_CLASSES.values()]:
+        for attribute in HOT_METHODS:
+            if attribute in vars(cls):
+                replace(cls, attribute, timed(stats, cls, attribute, vars(cls)[attribute]))
+    for attribute in POSITION_METHODS:
+        replace(chess.Position, attribute, timed(stats, chess.Position, attribute, vars(chess.Position)[attribute]))
+    replace(chess.Game, 'play', timed(stats, chess.Game, 'play', chess.Game.play)) # Parses and checks typed moves
+    for attribute in FUNCTIONS:
+        replace(chess, attribute, timed(stats, chess, attribute, vars(chess)[attribute]))
+    replace(chess.Square, '__init__', counted(stats, chess.Square.__init__))
+    return stats
+
+
+def disable() -> Stats:
+    # Puts the original methods back and returns what was counted
+    global STATS
+    while ORIGINALS:
+        owner, attribute, original = ORIGINALS.pop()
+        setattr(owner, attribute, original)
+    stats, STATS = STATS, None
+    return stats
+
+
+def dump_every(stats, seconds, stream = sys.stderr, as_json = False) -> threading.Event:
+    # Writes the stats every few seconds from a background thread until the returned event is set
+    stop = threading.Event()
+
+    def dump():
+        while not stop.wait(seconds):
+            print(json.dumps(stats.report()) if as_json else stats.format(), file=stream, flush=True)
+    threading.Thread(target=dump, daemon=True).start()
+    return stop
+
+
+def main(args) -> int:
+    # 'python3 instrument.py [--every seconds] [--json] [chess.py arguments]' runs chess.py with instrumentation on,
+    # e.g. 'python3 instrument.py perft 3' or 'python3 instrument.py --every 10' for a game, and reports on stderr
+    every, as_json = None, False
+    while args[:1] in (['--every'], ['--json']):
+        if args[0] == '--json':
+            as_json, args = True, args[1:]
+        else:
+            every, args = float(args[1]), args[2:]
+    stats = enable()
+    stop = dump_every(stats, every, as_json=as_json) if every else None
+    try:
+        status = chess.main(args)
+    except KeyboardInterrupt:
+        status = 1
+    finally:
+        if stop:
+            stop.set()
+        disable()
+        print(json.dumps(stats.report()) if as_json else stats.format(), file=sys.stderr)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
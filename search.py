@@ -0,0 +1,374 @@
+"""
+Move search for chess.py positions: negamax alpha-beta with iterative deepening
+"""
+
+import multiprocessing
+import queue
+import sys
+from multiprocessing import shared_memory
+from time import perf_counter
+
+from chess import PERFT_POSITIONS, Position, reverse_UCI_map
+from transposition import EXACT, LOWER, UPPER, TranspositionTable, table_bytes
+
+PIECE_VALUES = {'P': 100, 'N': 320, 'B': 330, 'R': 500, 'Q': 900, 'K': 0} # For move ordering, the evaluation is Position.evaluate()
+MATE = 30000 # Score of being mated now, mate in n plies scores MATE - n
+INFINITY = 32000
+MAX_PLY = 128
+MATE_BOUND = MATE - MAX_PLY # Scores beyond this are mates
+ASPIRATION = 50 # Half width of the first window around the previous iteration's score
+CHECK_EVERY = 64 # Nodes between looks at the clock and the stop event, a few milliseconds
+
+
+class SearchStopped(Exception):
+    # Raised inside the search when a limit is reached, the position is unwound by whoever catches it
+    pass
+
+
+def uci_move(move) -> str:
+    move_from, move_to, promotion = move
+    return f'{reverse_UCI_map[move_from]}{reverse_UCI_map[move_to]}{promotion or ""}'
+
+
+class Search:
+    # Finds a move for the side to move of a position, searching one ply deeper each iteration until a limit
+    # is hit and always keeping the best move found so far, so an answer is ready whenever time runs out
+
+    def __init__(self, position: Position, table = None, stop = None, helper = 0) -> None:
+        self.position = position
+        self.table = table or TranspositionTable(16)
+        self.stop = stop # Event that ends the search from outside when set, e.g. by another thread or process
+        self.helper = helper # Lazy SMP helpers (> 0) start at a different depth than the main search
+        self.killers = [[None, None] for _ in range(MAX_PLY)] # Two quiet moves per ply that caused a cutoff
+        self.history = [0] * 4096 # Cutoffs of quiet moves by move_from * 64 + move_to, weighted by depth
+        self.nodes = 0
+        self.deadline = None
+        self.node_limit = None
+        self.root_best = None
+
+    def check_limits(self) -> None:
+        if self.node_limit and self.nodes >= self.node_limit:
+            raise SearchStopped
+        if self.nodes % CHECK_EVERY == 0:
+            if self.deadline and perf_counter() >= self.deadline or self.stop is not None and self.stop.is_set():
+                raise SearchStopped
+
+    def order(self, moves, tt_move, ply) -> None:
+        # Sorts in place: hash move, captures by most valuable victim then least valuable attacker, promotions,
+        # killers, then quiet moves by history
+        board = self.position.board
+        killers = self.killers[ply]
+        history = self.history
+
+        def rank(move):
+            if move == tt_move:
+                return 1 << 30
+            victim = board[move[1]]
+            if not victim.is_empty():
+                return (1 << 29) + PIECE_VALUES[victim.type_.upper()] * 16 - PIECE_VALUES[board[move[0]].type_.upper()] // 16
+            if move[2]:
+                return (1 << 28) + PIECE_VALUES[move[2].upper()]
+            if move in killers:
+                return 1 << 27
+            return history[move[0] * 64 + move[1]]
+
+        moves.sort(key=rank, reverse=True)
+
+    def remember_cutoff(self, move, depth, ply) -> None:
+        killers = self.killers[ply]
+        if move != killers[0]:
+            killers[1], killers[0] = killers[0], move
+        index = move[0] * 64 + move[1]
+        self.history[index] += depth * depth
+        if self.history[index] > 1 << 20: # Keeps history below the killers and recent cutoffs weighing more
+            self.history = [value // 2 for value in self.history]
+
+    def quiescence(self, alpha, beta, ply) -> int:
+        # Only captures and promotions are searched so the evaluation is never taken in the middle of an exchange,
+        # in check every evasion is searched since standing still is not an option
+        self.nodes += 1
+        self.check_limits()
+        position = self.position
+        moves = position.generate_legal_moves()
+        in_check = position.in_check()
+        if not moves:
+            return -MATE + ply if in_check else 0
+        if ply >= MAX_PLY - 1:
+            return self.position.evaluate()
+
+        if not in_check:
+            stand_pat = self.position.evaluate()
+            if stand_pat >= beta:
+                return stand_pat
+            alpha = max(alpha, stand_pat)
+            board = position.board
+            moves = [move for move in moves if move[2] or not board[move[1]].is_empty()]
+        best = alpha if not in_check else -INFINITY
+        self.order(moves, None, ply)
+        for move in moves:
+            position.make_move(*move)
+            score = -self.quiescence(-beta, -alpha, ply + 1)
+            position.unmake_move()
+            if score > best:
+                best = score
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+        return best
+
+    def negamax(self, depth, alpha, beta, ply) -> int:
+        position = self.position
+        if depth <= 0:
+            return self.quiescence(alpha, beta, ply)
+        self.nodes += 1
+        self.check_limits()
+        if ply and (position.repetitions[position.key] > 1 or position.halfmove_clock >= 100 or position.insufficient_material()):
+            return 0 # A repeated position is scored as the draw either side can steer it to
+
+        key = position.key
+        tt_move = None
+        entry = self.table.probe(key)
+        if entry:
+            tt_depth, tt_score, bound, tt_move = entry
+            if ply and tt_depth >= depth:
+                tt_score = score_from_table(tt_score, ply)
+                if bound == EXACT or bound == LOWER and tt_score >= beta or bound == UPPER and tt_score <= alpha:
+                    return tt_score
+
+        moves = position.generate_legal_moves()
+        if not moves:
+            return -MATE + ply if position.in_check() else 0
+        self.order(moves, tt_move, ply)
+
+        original_alpha = alpha
+        best_score, best_move = -INFINITY, None
+        board = position.board
+        for move in moves:
+            position.make_move(*move)
+            score = -self.negamax(depth - 1, -beta, -alpha, ply + 1)
+            position.unmake_move()
+            if score > best_score:
+                best_score, best_move = score, move
+                if score > alpha:
+                    alpha = score
+                    if not ply:
+                        self.root_best = move # Searched in full, so it can be played even if the iteration is cut short
+                    if alpha >= beta:
+                        if board[move[1]].is_empty() and not move[2]:
+                            self.remember_cutoff(move, depth, ply)
+                        break
+
+        bound = UPPER if best_score <= original_alpha else LOWER if best_score >= beta else EXACT
+        self.table.store(key, depth, score_to_table(best_score, ply), bound, best_move)
+        return best_score
+
+    def principal_variation(self, depth) -> list:
+        # Follows the hash moves from the root, checking each is legal since entries can be overwritten
+        position = self.position
+        line = []
+        while len(line) < depth:
+            entry = self.table.probe(position.key)
+            if not entry or entry[3] not in position.generate_legal_moves():
+                break
+            line.append(entry[3])
+            position.make_move(*entry[3])
+        for _ in line:
+            position.unmake_move()
+        return line
+
+    def search(self, depth = MAX_PLY, movetime = None, nodes = None, info = None):
+        # Returns (best move, score, completed depth) within the limits, movetime in seconds,
+        # info(depth, score, nodes, seconds, principal variation) is called after each completed iteration
+        start = perf_counter()
+        self.deadline = start + movetime if movetime else None
+        self.node_limit = nodes
+        self.nodes = 0
+        position = self.position
+        undo_depth = len(position.undo)
+        own_cache = position.move_cache is None # Turned on for this search only, so a Game's position doesn't keep it
+        if own_cache:
+            position.move_cache, position.move_cache_bytes = {}, 0
+        try:
+            return self.iterate(depth, start, undo_depth, info)
+        finally:
+            if own_cache:
+                position.move_cache, position.move_cache_bytes = None, 0
+
+    def iterate(self, depth, start, undo_depth, info):
+        # The iterative deepening loop of search()
+        position = self.position
+        moves = position.generate_legal_moves()
+        if not moves:
+            return None, (-MATE if position.in_check() else 0), 0
+        self.order(moves, None, 0)
+        best_move, score, completed = moves[0], 0, 0
+
+        try:
+            for iteration in range(1 + self.helper % 2, min(depth, MAX_PLY - 1) + 1):
+                self.root_best = None
+                delta = ASPIRATION
+                alpha, beta = (score - delta, score + delta) if iteration >= 3 else (-INFINITY, INFINITY)
+                while True:
+                    value = self.negamax(iteration, alpha, beta, 0)
+                    if self.root_best:
+                        best_move = self.root_best
+                    if value <= alpha:
+                        alpha = max(-INFINITY, alpha - delta)
+                    elif value >= beta:
+                        beta = min(INFINITY, beta + delta)
+                    else:
+                        break
+                    delta *= 2
+                score, completed = value, iteration
+                if info:
+                    info(completed, score, self.nodes, perf_counter() - start, self.principal_variation(completed))
+                if abs(score) >= MATE_BOUND and MATE - abs(score) <= iteration:
+                    break # A forced mate shorter than the depth searched won't change with more depth
+                if self.deadline and perf_counter() - start > (self.deadline - start) / 2:
+                    break # The next iteration would most likely not finish in the time left
+        except SearchStopped:
+            while len(position.undo) > undo_depth:
+                position.unmake_move()
+            if self.root_best:
+                best_move = self.root_best
+        return best_move, score, completed
+
+
+def score_to_table(score, ply) -> int:
+    # Mate scores are stored as distance from the stored position rather than from the root
+    if score >= MATE_BOUND:
+        return score + ply
+    if score <= -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def score_from_table(score, ply) -> int:
+    if score >= MATE_BOUND:
+        return score - ply
+    if score <= -MATE_BOUND:
+        return score + ply
+    return score
+
+
+def smp_worker(index, fen, table_name, depth, movetime, nodes, stop, results):
+    # One Lazy SMP process: its own Position built from the FEN, the transposition table shared with the others
+    memory = shared_memory.SharedMemory(name=table_name)
+    table = TranspositionTable(buffer=memory.buf)
+    info = None
+    if index == 0:
+        def info(*iteration):
+            results.put(('info', *iteration))
+    try:
+        search = Search(Position.from_fen(fen), table, stop, index)
+        # Helpers go one ply deeper so they are still busy, and filling the table, when the main search ends
+        move, score, completed = search.search(depth + (index > 0), movetime, nodes, info)
+        results.put(('done', index, move, score, completed, search.nodes))
+    finally:
+        table.close()
+        memory.close()
+
+
+def parallel_search(position: Position, workers = None, depth = MAX_PLY, movetime = None, nodes = None, info = None, megabytes = 64):
+    # Lazy SMP: every worker process searches the same root and they share one transposition table in shared
+    # memory, so what one finds shortens the others' searches. The main worker's (index 0) iterations are reported
+    # through info and its end stops the helpers; the move from the deepest completed search is returned as
+    # (best move, score, completed depth, total nodes)
+    workers = workers or multiprocessing.cpu_count()
+    fen = position.to_fen()
+    memory = shared_memory.SharedMemory(create=True, size=table_bytes(megabytes))
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=smp_worker, args=(index, fen, memory.name, depth, movetime, nodes, stop, results))
+                 for index in range(workers)]
+    try:
+        for process in processes:
+            process.start()
+        done = {}
+        while len(done) < workers:
+            try:
+                message = results.get(timeout=1)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    break # A worker died without reporting, don't wait for it forever
+                if 0 not in done and not processes[0].is_alive():
+                    stop.set() # Nothing to wait for without the main worker, see below
+                continue
+            if message[0] == 'info':
+                if info:
+                    info(*message[1:])
+                continue
+            _, index, move, score, completed, worker_nodes = message
+            done[index] = (move, score, completed, worker_nodes)
+            if index == 0:
+                stop.set()
+        for process in processes:
+            process.join()
+    finally:
+        stop.set()
+        memory.close()
+        memory.unlink()
+
+    if 0 not in done:
+        # The main worker died without a result (its exit code is on stderr), search here so the caller still gets a
+        # move, an error in the search itself is then raised in this process with its traceback
+        print(f'parallel_search: main worker ended with exit code {processes[0].exitcode} and no result, '
+              'searching in this process', file=sys.stderr)
+        search = Search(Position.from_fen(fen), TranspositionTable(megabytes))
+        move, score, completed = search.search(depth, movetime, nodes, info)
+        return move, score, completed, search.nodes
+
+    total_nodes = sum(result[3] for result in done.values())
+    best = max(done.items(), key=lambda item: (item[1][2], -item[0]))[1] # Deepest search, the main one on ties
+    return best[0], best[1], best[2], total_nodes
+
+
+def benchmark(depth = 5, max_workers = None):
+    # Time to reach a fixed depth and total nodes per second on the perft positions with 1 to max_workers processes
+    max_workers = max_workers or multiprocessing.cpu_count()
+    base = None
+    for workers in range(1, max_workers + 1):
+        elapsed = total_nodes = 0
+        for name, fen, _ in PERFT_POSITIONS:
+            start = perf_counter()
+            _, _, _, searched = parallel_search(Position.from_fen(fen), workers, depth)
+            elapsed += perf_counter() - start
+            total_nodes += searched
+        base = base or elapsed
+        print(f'{workers} workers: depth {depth} in {elapsed:.2f}s ({base / elapsed:.2f}x), '
+              f'{total_nodes} nodes, {total_nodes / elapsed:.0f} nodes/s')
+
+
+def main(args):
+    # 'python3 search.py [--depth n] [--movetime ms] [--nodes n] [--workers n] [fen]' prints each iteration and
+    # the best move, 'python3 search.py bench [depth] [max workers]' measures how the search scales over cores
+    if args[:1] == ['bench']:
+        benchmark(*[int(arg) for arg in args[1:3]])
+        return 0
+    limits = {'depth': MAX_PLY, 'movetime': None, 'nodes': None, 'workers': None}
+    while args[:1] and args[0][2:] in limits:
+        limits[args[0][2:]], args = int(args[1]), args[2:]
+    if limits['depth'] == MAX_PLY and not limits['movetime'] and not limits['nodes']:
+        limits['movetime'] = 5000
+    if args:
+        position = Position.from_fen(' '.join(args))
+    else:
+        position = Position()
+        position.initialize_board()
+
+    def info(depth, score, nodes, seconds, line):
+        print(f'depth {depth} score {score} nodes {nodes} time {seconds * 1000:.0f} nps {nodes / max(seconds, 1e-9):.0f} '
+              f'pv {" ".join(uci_move(move) for move in line)}')
+
+    movetime = limits['movetime'] and limits['movetime'] / 1000
+    if limits['workers']:
+        move, *_ = parallel_search(position, limits['workers'], limits['depth'], movetime, limits['nodes'], info)
+    else:
+        move, score, depth = Search(position).search(limits['depth'], movetime, limits['nodes'], info)
+    print(f'bestmove {uci_move(move) if move else "(none)"}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,250 @@
+"""
+Game server for chess.py: hosts many games in one process over TCP, one text command per line
+"""
+
+import asyncio
+import random
+import sys
+from itertools import count
+from time import monotonic, perf_counter
+
+from chess import Game, IllegalMove, reverse_UCI_map
+
+HOST = '127.0.0.1'
+PORT = 8765
+IDLE_TIMEOUT = 600 # Seconds without a move before a game is dropped
+
+# Protocol, every message is one line of space separated words
+#   new [fen]                 -> created <id> <fen> [<result> <reason>]   starts a game and follows it
+#   watch <id>                -> board <id> <fen>             follows a game
+#   move <id> <uci>           -> update <id> <uci> <fen> [<result> <reason>]   sent to everyone following the game
+#   resign <id> <color>       -> update <id> resign <fen> <result> resignation
+#   stats                     -> stats games <n> moves <n> connections <n>
+#   quit
+# Mistakes get 'error <id or -> <message>' and only the sender sees them, dropped games send 'evicted <id>'
+
+
+class GameSession:
+    # A hosted game with the connections following it, the lock keeps the moves of a game and the updates they
+    # send in order when several clients play on it at once
+
+    def __init__(self, game_id: int, game: Game) -> None:
+        self.game_id = game_id
+        self.game = game
+        self.lock = asyncio.Lock()
+        self.watchers = set() # StreamWriters of the connections following the game
+        self.last_active = monotonic()
+
+
+class GameServer:
+
+    def __init__(self, idle_timeout = IDLE_TIMEOUT) -> None:
+        self.games = {}
+        self.ids = count(1)
+        self.idle_timeout = idle_timeout
+        self.connections = 0
+        self.moves = 0
+
+    async def serve(self, host = HOST, port = PORT) -> None:
+        server = await asyncio.start_server(self.connection, host, port, limit=1 << 16)
+        evictor = asyncio.ensure_future(self.evict_idle())
+        print(f'Serving games on {host}:{port}', file=sys.stderr)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            evictor.cancel()
+
+    async def connection(self, reader, writer) -> None:
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError: # Longer than the limit, readline() drops it
+                    writer.write(b'error - line too long\n')
+                    await writer.drain()
+                    continue
+                if not line:
+                    break
+                try:
+                    words = line.decode().split()
+                except UnicodeDecodeError:
+                    writer.write(b'error - not UTF-8\n')
+                    await writer.drain()
+                    continue
+                if words[:1] == ['quit']:
+                    break
+                if words:
+                    try:
+                        await self.command(words, writer)
+                    except ConnectionError:
+                        raise
+                    except Exception as error: # A bug hit by one line is answered, the connection and the server go on
+                        print(f'{" ".join(words)[:80]}: {error!r}', file=sys.stderr)
+                        writer.write(f'error - {type(error).__name__}\n'.encode())
+                    await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections -= 1
+            for session in self.games.values():
+                session.watchers.discard(writer)
+            writer.close()
+
+    async def command(self, words, writer) -> None:
+        command, args = words[0], words[1:]
+        if command == 'new':
+            try:
+                game = Game(' '.join(args) or None)
+            except ValueError as error:
+                writer.write(f'error - {error}\n'.encode())
+                return
+            session = GameSession(next(self.ids), game)
+            session.watchers.add(writer)
+            self.games[session.game_id] = session
+            created = f'created {session.game_id} {game.position.to_fen()}'
+            if game.result: # The FEN was already mate, stalemate or a draw
+                created += f' {game.result} {game.reason}'
+            writer.write(f'{created}\n'.encode())
+        elif command == 'stats':
+            writer.write(f'stats games {len(self.games)} moves {self.moves} connections {self.connections}\n'.encode())
+        elif command in ('watch', 'move', 'resign'):
+            session = self.games.get(int(args[0])) if args and args[0].isascii() and args[0].isdigit() else None
+            if session is None:
+                writer.write(f'error {args[0] if args else "-"} no such game\n'.encode())
+            elif command == 'watch':
+                session.watchers.add(writer)
+                writer.write(f'board {session.game_id} {session.game.position.to_fen()}\n'.encode())
+            else:
+                await self.play(session, command, args[1:], writer)
+        else:
+            writer.write(f'error - unknown command {command}\n'.encode())
+
+    async def play(self, session, command, args, writer) -> None:
+        async with session.lock:
+            game = session.game
+            try:
+                if command == 'resign':
+                    if args[:1] not in (['White'], ['Black']) or game.result:
+                        raise IllegalMove('resign needs White or Black and a game in progress')
+                    game.resign(args[0])
+                    move = 'resign'
+                else:
+                    move = args[0] if args else ''
+                    game.play(move)
+                    self.moves += 1
+            except IllegalMove as error:
+                writer.write(f'error {session.game_id} {error}\n'.encode())
+                return
+            session.last_active = monotonic()
+            update = f'update {session.game_id} {move} {game.position.to_fen()}'
+            if game.result:
+                update += f' {game.result} {game.reason}'
+            update = (update + '\n').encode()
+            if writer not in session.watchers:
+                writer.write(update) # The mover hears back even without following the game
+            for watcher in list(session.watchers):
+                watcher.write(update)
+            # Waits for slow watchers while holding the lock so every watcher gets a game's updates in order
+            for watcher in list(session.watchers):
+                if watcher is not writer:
+                    try:
+                        await watcher.drain()
+                    except ConnectionError:
+                        session.watchers.discard(watcher)
+
+    async def evict_idle(self) -> None:
+        # Drops games nobody has moved in for idle_timeout seconds, so memory follows the games actually played
+        while True:
+            await asyncio.sleep(max(1, self.idle_timeout / 4))
+            cutoff = monotonic() - self.idle_timeout
+            for game_id, session in list(self.games.items()):
+                if session.last_active < cutoff and not session.lock.locked():
+                    del self.games[game_id]
+                    for watcher in session.watchers:
+                        watcher.write(f'evicted {game_id}\n'.encode())
+
+
+def random_lines(number, length, seed = 0) -> list:
+    # Random legal move sequences, prepared before a load test so the client spends its time on the network
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(number):
+        game = Game()
+        while len(game.moves) < length and not game.result:
+            move_from, move_to, promotion = rng.choice(game.legal_moves)
+            game.play(f'{reverse_UCI_map[move_from]}{reverse_UCI_map[move_to]}{promotion or ""}')
+        lines.append(game.moves)
+    return lines
+
+
+async def load_client(games, lines, host, port, latencies, errors) -> None:
+    # One connection playing its games side by side, every round sends a move in each game before reading the
+    # replies, which come back in the order the moves were sent
+    reader, writer = await asyncio.open_connection(host, port, limit=1 << 16)
+    ids = []
+    for _ in range(games):
+        writer.write(b'new\n')
+    await writer.drain()
+    for _ in range(games):
+        ids.append(int((await reader.readline()).split()[1]))
+    for ply in range(max(len(line) for line in lines)):
+        playing = [(game_id, line[ply]) for game_id, line in zip(ids, lines) if ply < len(line)]
+        sent = perf_counter()
+        writer.write(''.join(f'move {game_id} {move}\n' for game_id, move in playing).encode())
+        await writer.drain()
+        for _ in playing:
+            reply = await reader.readline()
+            latencies.append(perf_counter() - sent)
+            if not reply.startswith(b'update'):
+                errors.append(reply.decode().strip())
+    writer.write(b'quit\n')
+    await writer.drain()
+    writer.close()
+
+
+async def load_test(games = 1000, connections = 50, moves = 20, host = HOST, port = PORT) -> None:
+    # Plays `games` games at once over `connections` connections and reports moves per second and move latency
+    pool = random_lines(min(games, 200), moves)
+    latencies, errors = [], []
+    per_connection = [games // connections + (index < games % connections) for index in range(connections)]
+    assigned, start_line = [], 0
+    for number in per_connection:
+        assigned.append([pool[(start_line + offset) % len(pool)] for offset in range(number)])
+        start_line += number
+    start = perf_counter()
+    await asyncio.gather(*(load_client(number, lines, host, port, latencies, errors)
+                           for number, lines in zip(per_connection, assigned) if number))
+    elapsed = perf_counter() - start
+    latencies.sort()
+    percentile = lambda fraction: latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+    print(f'{games} games over {connections} connections: {len(latencies)} moves in {elapsed:.2f}s, '
+          f'{len(latencies) / elapsed:.0f} moves/s, latency p50 {percentile(0.5):.1f}ms p99 {percentile(0.99):.1f}ms, '
+          f'{len(errors)} errors')
+    for error in errors[:5]:
+        print(error)
+
+
+def main(args) -> int:
+    # 'python3 server.py [--host h] [--port p] [--idle seconds]' serves games,
+    # 'python3 server.py loadtest [--games n] [--connections n] [--moves n] [--host h] [--port p]' measures a running server
+    loadtest = args[:1] == ['loadtest']
+    options = {'host': HOST, 'port': PORT, 'idle': IDLE_TIMEOUT, 'games': 1000, 'connections': 50, 'moves': 20}
+    args = args[1:] if loadtest else args
+    while len(args) >= 2 and args[0][2:] in options:
+        name, value = args[0][2:], args[1]
+        options[name] = value if name == 'host' else int(value)
+        args = args[2:]
+    try:
+        if loadtest:
+            asyncio.run(load_test(options['games'], options['connections'], options['moves'], options['host'], options['port']))
+        else:
+            asyncio.run(GameServer(options['idle']).serve(options['host'], options['port']))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
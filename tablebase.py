@@ -0,0 +1,392 @@
+"""
+Endgame tablebases for chess.py: retrograde generation of distance to mate tables and mmap probing
+"""
+
+import mmap
+import os
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+from chess import KING_ATTACKS, KNIGHT_ATTACKS, PAWN_ATTACKS, Position, bishop_attacks, bit_squares, rook_attacks
+
+# Material sets: the pieces the strong side has besides its king, the other side has a bare king
+# Extra pieces are listed in QRBNP order, which is also the order of their squares in an index
+SETS = {'KQK': 'Q', 'KRK': 'R', 'KPK': 'P', 'KBNK': 'BN'}
+DEPENDENCIES = {'KPK': ('KQK', 'KRK')} # Tables a set's moves lead into, promotions to B or N are draws
+PIECE_ORDER = 'QRBNP'
+DIRECTORY = 'tablebases'
+
+# One byte per index: 0 draw, 255 impossible position, otherwise plies to mate + 1, so odd values are losses for
+# the side to move (1 is checkmated) and even values are wins
+DRAW, INVALID = 0, 255
+
+
+class Layout:
+    # Index of a position in a set's table: the side to move (0 when the strong side moves), the strong king,
+    # the bare king and then the extra pieces, 6 bits each. The strong side is always White in a table,
+    # positions where Black is strong are probed with the colors swapped and the board flipped
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.extra = SETS[name]
+        self.pieces = 2 + len(self.extra)
+        self.size = 2 << 6 * self.pieces
+
+    def index(self, turn: int, squares) -> int:
+        index = turn
+        for square in squares:
+            index = index << 6 | square
+        return index
+
+    def decode(self, index: int):
+        squares = []
+        for _ in range(self.pieces):
+            squares.append(index & 63)
+            index >>= 6
+        squares.reverse()
+        return index, squares
+
+
+LAYOUTS = {name: Layout(name) for name in SETS}
+
+
+def attacks(type_, square, occupancy) -> int:
+    # Squares a White piece attacks, with the project's tables
+    if type_ == 'K':
+        return KING_ATTACKS[square]
+    if type_ == 'Q':
+        return rook_attacks(square, occupancy) | bishop_attacks(square, occupancy)
+    if type_ == 'R':
+        return rook_attacks(square, occupancy)
+    if type_ == 'B':
+        return bishop_attacks(square, occupancy)
+    if type_ == 'N':
+        return KNIGHT_ATTACKS[square]
+    return PAWN_ATTACKS['White'][square]
+
+
+def strong_attacks(extra, squares, occupancy) -> int:
+    # Everything the strong side attacks, occupancy should leave out the bare king so it can't hide behind itself
+    attacked = KING_ATTACKS[squares[0]]
+    for type_, square in zip(extra, squares[2:]):
+        attacked |= attacks(type_, square, occupancy)
+    return attacked
+
+
+def is_valid(extra, turn, squares) -> bool:
+    # Distinct squares, no pawn on the first or last rank, kings apart, and the side that just moved not in check
+    if len(set(squares)) != len(squares) or KING_ATTACKS[squares[0]] >> squares[1] & 1:
+        return False
+    for type_, square in zip(extra, squares[2:]):
+        if type_ == 'P' and square // 8 in (0, 7):
+            return False
+    if turn == 0: # The bare king must not be left in check with the strong side to move
+        occupancy = sum(1 << square for square in squares)
+        return not strong_attacks(extra, squares, occupancy) >> squares[1] & 1
+    return True
+
+
+def bare_king_moves(extra, squares):
+    # Legal moves of the bare king as (destination, captures), and whether it is in check
+    occupancy = sum(1 << square for square in squares)
+    attacked = strong_attacks(extra, squares, occupancy & ~(1 << squares[1]))
+    moves = [(target, target in squares[2:]) for target in bit_squares(KING_ATTACKS[squares[1]] & ~attacked)]
+    return moves, bool(attacked >> squares[1] & 1)
+
+
+def unmoves(type_, square, occupancy):
+    # Squares a strong side piece now on square could have come from without capturing or promoting
+    empty = ~occupancy
+    if type_ == 'P':
+        origins = []
+        if square - 8 >= 8 and empty >> (square - 8) & 1:
+            origins.append(square - 8)
+            if 24 <= square < 32 and empty >> (square - 16) & 1:
+                origins.append(square - 16)
+        return origins
+    return bit_squares(attacks(type_, square, occupancy) & empty)
+
+
+def table_path(directory, name) -> str:
+    return os.path.join(directory, name + '.tb')
+
+
+def generate(name, directory = DIRECTORY, log = None) -> str:
+    # Builds a set's table by retrograde analysis: starting from the checkmates, every level of distance to mate is
+    # found from the one before by taking moves back. A position with the strong side to move is won as soon as one
+    # move leads to a lost position, one with the bare king to move is lost once every move leads to a won one,
+    # counted down in `remaining`, a byte per index like the table. The table is saved at the start of each level to
+    # a .partial file, and an interrupted run carries on from there
+    layout = Layout(name)
+    extra = layout.extra
+    path = table_path(directory, name)
+    partial = path + '.partial'
+    if os.path.exists(path):
+        return path
+    os.makedirs(directory, exist_ok=True)
+    log = log or (lambda message: None)
+    start = perf_counter()
+
+    level = 0
+    if os.path.exists(partial):
+        with open(partial, 'rb') as file:
+            level = int.from_bytes(file.read(1), 'little')
+            values = bytearray(file.read())
+        log(f'{name}: resuming at level {level}')
+    else:
+        values = bytearray(layout.size)
+
+    # One pass over the table: marks impossible positions, counts the bare king's moves (less those into positions
+    # already known to be won up to the levels done) and finds the checkmates
+    remaining = bytearray(layout.size)
+    frontier = []
+    for index in range(layout.size):
+        turn, squares = layout.decode(index)
+        if not is_valid(extra, turn, squares):
+            values[index] = INVALID
+            continue
+        if values[index]:
+            if values[index] == level + 1:
+                frontier.append(index)
+            continue
+        if turn == 1:
+            moves, in_check = bare_king_moves(extra, squares)
+            count = 0
+            for target, captures in moves:
+                child = values[layout.index(0, [squares[0], target] + squares[2:])] if not captures else DRAW
+                if not (child and child != INVALID and child % 2 == 0 and child <= level):
+                    count += 1
+            if count == 0 and in_check: # Only on a fresh start, a resumed table has its checkmates already
+                values[index] = 1
+                frontier.append(index)
+            else:
+                remaining[index] = count
+    log(f'{name}: {layout.size} indices set up in {perf_counter() - start:.1f}s')
+
+    seeds = promotion_seeds(layout, values, directory) if 'P' in extra else {}
+
+    while True:
+        with open(partial + '.tmp', 'wb') as file: # Checkpoint, everything up to this level is settled
+            file.write(bytes([level]))
+            file.write(values)
+        os.replace(partial + '.tmp', partial)
+
+        for index in seeds.get(level + 1, ()):
+            if not values[index]:
+                values[index] = level + 1
+                frontier.append(index)
+        if not frontier and not any(value > level + 1 for value in seeds):
+            break
+        log(f'{name}: level {level}, {len(frontier)} positions')
+
+        next_frontier = []
+        for index in frontier:
+            turn, squares = layout.decode(index)
+            occupancy = sum(1 << square for square in squares)
+            if turn == 1:
+                # Lost with the bare king to move: every strong side move leading here wins
+                for piece, (type_, square) in enumerate(zip('K' + extra, [squares[0]] + squares[2:])):
+                    slot = 0 if piece == 0 else piece + 1
+                    for origin in unmoves(type_, square, occupancy):
+                        before = squares[:]
+                        before[slot] = origin
+                        if type_ == 'K' and KING_ATTACKS[origin] >> squares[1] & 1:
+                            continue
+                        parent = layout.index(0, before)
+                        if values[parent] == DRAW and is_valid(extra, 0, before):
+                            values[parent] = level + 2
+                            next_frontier.append(parent)
+            else:
+                # Won with the strong side to move: the bare king moves leading here lose once none are left
+                for origin in bit_squares(KING_ATTACKS[squares[1]] & ~occupancy & ~KING_ATTACKS[squares[0]]):
+                    parent = layout.index(1, [squares[0], origin] + squares[2:])
+                    if remaining[parent] and values[parent] == DRAW:
+                        remaining[parent] -= 1
+                        if remaining[parent] == 0:
+                            values[parent] = level + 2
+                            next_frontier.append(parent)
+        frontier = next_frontier
+        level += 1
+        if level >= INVALID - 1:
+            raise ValueError(f'{name}: distance to mate does not fit in a byte')
+
+    with open(path + '.tmp', 'wb') as file:
+        file.write(values)
+    os.replace(path + '.tmp', path)
+    os.remove(partial)
+    log(f'{name}: done in {perf_counter() - start:.1f}s, longest mate {level - 1} plies')
+    return path
+
+
+def promotion_seeds(layout, values, directory) -> dict:
+    # KPK positions won by promoting, by the value the promotion gives them, from the queen and rook tables
+    # (promotions to bishop or knight only draw). These are found by moving forward since no move in the table
+    # can be taken back to them
+    tablebase = Tablebase(directory)
+    tables = [tablebase.table(name) for name in DEPENDENCIES['KPK']]
+    seeds = {}
+    for pawn_square in range(48, 56):
+        for white_king in range(64):
+            for black_king in range(64):
+                squares = [white_king, black_king, pawn_square]
+                target = pawn_square + 8
+                index = layout.index(0, squares)
+                if values[index] == INVALID or target in squares:
+                    continue
+                best = None
+                for table in tables:
+                    child = table[layout.index(1, [white_king, black_king, target])]
+                    if child and child != INVALID and child % 2 == 1: # Lost for the bare king
+                        best = child + 1 if best is None else min(best, child + 1)
+                if best:
+                    seeds.setdefault(best, []).append(index)
+    tablebase.close()
+    return seeds
+
+
+def generate_all(names = tuple(SETS), directory = DIRECTORY, workers = None) -> None:
+    # One process per set, sets wait for the tables their moves lead into, which are added when not asked for
+    pending = []
+    for name in names:
+        for needed in DEPENDENCIES.get(name, ()) + (name,):
+            if needed not in pending:
+                pending.append(needed)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while pending:
+            ready = [name for name in pending if not any(dependency in pending for dependency in DEPENDENCIES.get(name, ()))]
+            for path in executor.map(generate, ready, [directory] * len(ready), [print_log] * len(ready)):
+                print(f'{path} ready', file=sys.stderr)
+            pending = [name for name in pending if name not in ready]
+
+
+def print_log(message) -> None:
+    print(message, file=sys.stderr, flush=True)
+
+
+class Tablebase:
+    # Probes the tables of a directory, each file is mapped into memory on first use and read a byte at a time,
+    # so a probe costs a page fault at most and tables are never loaded whole
+
+    def __init__(self, directory = DIRECTORY) -> None:
+        self.directory = directory
+        self.maps = {}
+
+    def table(self, name):
+        if name not in self.maps:
+            path = table_path(self.directory, name)
+            if not os.path.exists(path):
+                self.maps[name] = None
+            else:
+                with open(path, 'rb') as file:
+                    self.maps[name] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[name]
+
+    def probe(self, position: Position):
+        # ('win', plies) or ('loss', plies) to mate for the side to move, ('draw', None), or None when the material is
+        # not covered or its table has not been generated
+        pieces = position.board.pieces
+        white, black = [], []
+        for order, type_ in enumerate(PIECE_ORDER):
+            white += [(order, square) for square in bit_squares(pieces[type_])]
+            black += [(order, square) for square in bit_squares(pieces[type_.lower()])]
+        if white and black:
+            return None
+        if not white and not black:
+            return 'draw', None
+        strong = 'White' if white else 'Black'
+        extra = white or black
+        name = 'K' + ''.join(PIECE_ORDER[order] for order, _ in extra) + 'K'
+        if name in ('KBK', 'KNK'):
+            return 'draw', None # No mate can be forced or even helped along
+        if name not in SETS:
+            return None
+        table = self.table(name)
+        if table is None:
+            return None
+
+        # The strong side plays White in the tables, Black's pieces are flipped rank for rank
+        flip = 0 if strong == 'White' else 56
+        squares = [position.kings[strong].position ^ flip, position.kings['Black' if strong == 'White' else 'White'].position ^ flip]
+        squares += [square ^ flip for _, square in extra]
+        value = table[LAYOUTS[name].index(0 if position.turn == strong else 1, squares)]
+        if value == DRAW:
+            return 'draw', None
+        if value == INVALID:
+            return None
+        return ('loss' if value % 2 else 'win'), value - 1
+
+    def close(self) -> None:
+        for table in self.maps.values():
+            if table is not None:
+                table.close()
+        self.maps = {}
+
+
+def verify(name, samples = 1000, directory = DIRECTORY, seed = 0) -> int:
+    # Checks random positions of a table against chess.py's own moves: a win must have a move into a loss one ply
+    # shorter and none quicker, a loss must have every move leading to a win and one of them exactly one ply shorter,
+    # a checkmate must be one. Returns the number of positions that disagree
+    layout = Layout(name)
+    tablebase = Tablebase(directory)
+    rng = random.Random(seed)
+    mismatches = checked = 0
+    while checked < samples:
+        index = rng.randrange(layout.size)
+        turn, squares = layout.decode(index)
+        if not is_valid(layout.extra, turn, squares):
+            continue
+        placement = [' '] * 64
+        placement[squares[0]], placement[squares[1]] = 'K', 'k'
+        for type_, square in zip(layout.extra, squares[2:]):
+            placement[square] = type_
+        position = Position.build(''.join(placement), 'White' if turn == 0 else 'Black', 0, None, 0, 1)
+        checked += 1
+        result, plies = tablebase.probe(position)
+        children = []
+        for move in position.generate_legal_moves():
+            position.make_move(*move)
+            children.append(tablebase.probe(position))
+            position.unmake_move()
+        losses = [child[1] for child in children if child and child[0] == 'loss']
+        wins = [child[1] for child in children if child and child[0] == 'win']
+        if result == 'win':
+            ok = bool(losses) and min(losses) == plies - 1
+        elif result == 'loss':
+            ok = len(wins) == len(children) and (max(wins) == plies - 1 if children else plies == 0 and position.is_checkmate())
+        else:
+            ok = not losses and len(wins) < len(children) or not children and not position.in_check()
+        if not ok:
+            mismatches += 1
+            print(f'{name}: {position.to_fen()} probed {result} {plies}', file=sys.stderr)
+    tablebase.close()
+    return mismatches
+
+
+def main(args) -> int:
+    # 'python3 tablebase.py generate [set...] [--workers n]' builds tables into ./tablebases (KQK KRK KPK KBNK),
+    # 'python3 tablebase.py probe <fen>' looks a position up, 'python3 tablebase.py verify set [samples]' checks a table
+    if args[:1] == ['generate']:
+        workers = None
+        if '--workers' in args:
+            index = args.index('--workers')
+            workers, args = int(args[index + 1]), args[:index] + args[index + 2:]
+        generate_all(args[1:] or tuple(SETS), workers=workers)
+        return 0
+    if args[:1] == ['probe'] and len(args) > 1:
+        position = Position.from_fen(' '.join(args[1:]))
+        start = perf_counter()
+        result = Tablebase().probe(position)
+        print(f'{result} in {(perf_counter() - start) * 1e6:.0f} microseconds')
+        return 0
+    if args[:1] == ['verify'] and len(args) > 1:
+        mismatches = verify(args[1], int(args[2]) if len(args) > 2 else 1000)
+        print(f'{args[1]}: {mismatches} mismatches')
+        return 0 if mismatches == 0 else 1
+    print('usage: tablebase.py generate [set...] [--workers n] | probe <fen> | verify set [samples]')
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
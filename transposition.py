@@ -0,0 +1,130 @@
+"""
+Transposition table for chess.py positions
+"""
+
+EXACT, LOWER, UPPER = 1, 2, 3 # Bound types: exact score, fail high (score is a lower bound), fail low (upper bound)
+PROMOTION_CODES = {None: 0, 'q': 1, 'r': 2, 'b': 3, 'n': 4}
+PROMOTION_LETTERS = {code: letter for letter, code in PROMOTION_CODES.items()}
+ENTRY_WORDS = 2 # A 64 bit word for the key and one for the data
+BUCKET_WORDS = 2 * ENTRY_WORDS # A depth preferred entry followed by an always replace entry
+BUCKET_BYTES = BUCKET_WORDS * 8
+
+
+def encode_move(move) -> int:
+    # Packs a (move_from, move_to, promotion) tuple from generate_legal_moves() in 15 bits, 0 means no move
+    if move is None:
+        return 0
+    move_from, move_to, promotion = move
+    return move_from | move_to << 6 | PROMOTION_CODES[promotion] << 12
+
+
+def decode_move(code: int):
+    if not code:
+        return None
+    return code & 63, code >> 6 & 63, PROMOTION_LETTERS[code >> 12]
+
+
+def pack(depth: int, score: int, bound: int, move: int) -> int:
+    # Data word: bits 0-15 move, 16-31 score offset to be positive, 32-39 depth, 40-41 bound
+    # An empty slot is all zeros, which never matches since a stored bound is never 0
+    score = max(-32767, min(32767, score))
+    return move | (score + 32768) << 16 | max(0, min(255, depth)) << 32 | bound << 40
+
+
+def unpack(data: int):
+    return data >> 32 & 255, (data >> 16 & 65535) - 32768, data >> 40 & 3, data & 65535
+
+
+def table_bytes(megabytes) -> int:
+    # Largest power of 2 number of buckets that fits in the given size, so a key finds its bucket with a mask
+    buckets = 1
+    while buckets * 2 * BUCKET_BYTES <= megabytes * 1024 * 1024:
+        buckets *= 2
+    return buckets * BUCKET_BYTES
+
+
+class TranspositionTable:
+    # Fixed size hash table of search results keyed by Position.key, allocated once so memory never grows
+    # Entries live in a flat buffer of 64 bit words rather than Python objects, and any writable buffer can be
+    # given (e.g. shared memory so several processes use one table). Keys are stored XORed with their data so a
+    # slot half written by another process reads as a miss instead of a wrong entry
+
+    def __init__(self, megabytes = 16, buffer = None) -> None:
+        if buffer is None:
+            buffer = bytearray(table_bytes(megabytes))
+        self.buffer = buffer
+        view = memoryview(buffer).cast('B')
+        buckets = 1
+        while buckets * 2 * BUCKET_BYTES <= len(view):
+            buckets *= 2
+        self.bytes = view[:buckets * BUCKET_BYTES]
+        self.words = self.bytes.cast('Q')
+        self.mask = buckets - 1
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.collisions = 0 # Stores that pushed out a different position's entry
+
+    def probe(self, key: int):
+        # Returns (depth, score, bound, move) stored for the key, or None
+        words = self.words
+        index = (key & self.mask) * BUCKET_WORDS
+        for slot in (index, index + ENTRY_WORDS):
+            data = words[slot + 1]
+            if data and words[slot] ^ data == key:
+                self.hits += 1
+                depth, score, bound, move = unpack(data)
+                return depth, score, bound, decode_move(move)
+        self.misses += 1
+        return None
+
+    def store(self, key: int, depth: int, score: int, bound: int, move = None) -> None:
+        # The first slot of a bucket keeps the deepest result, the second takes whatever the first refuses,
+        # so deep results survive and recent shallow ones still get a place
+        words = self.words
+        index = (key & self.mask) * BUCKET_WORDS
+        old_data = words[index + 1]
+        old_key = words[index] ^ old_data
+        data = pack(depth, score, bound, encode_move(move))
+        self.stores += 1
+
+        if not old_data or old_key == key or depth >= unpack(old_data)[0]:
+            if old_data and old_key != key:
+                # The replaced deep entry moves down to the always replace slot
+                self.evict(index + ENTRY_WORDS, key)
+                words[index + ENTRY_WORDS], words[index + ENTRY_WORDS + 1] = words[index], old_data
+            elif old_key == key and words[index + ENTRY_WORDS + 1] and words[index + ENTRY_WORDS] ^ words[index + ENTRY_WORDS + 1] == key:
+                words[index + ENTRY_WORDS + 1] = 0 # Don't keep an older copy of the same position in the second slot
+            words[index], words[index + 1] = key ^ data, data
+        else:
+            self.evict(index + ENTRY_WORDS, key)
+            words[index + ENTRY_WORDS], words[index + ENTRY_WORDS + 1] = key ^ data, data
+
+    def evict(self, slot: int, key: int) -> None:
+        # Counts a collision when the slot about to be written holds another position
+        data = self.words[slot + 1]
+        if data and self.words[slot] ^ data != key:
+            self.collisions += 1
+
+    def clear(self) -> None:
+        chunk = bytes(1 << 20) # Zeroed a megabyte at a time so clearing a big table doesn't allocate a copy of it
+        for start in range(0, len(self.bytes), len(chunk)):
+            end = min(start + len(chunk), len(self.bytes))
+            self.bytes[start:end] = chunk[:end - start]
+        self.hits = self.misses = self.stores = self.collisions = 0
+
+    def close(self) -> None:
+        # Lets go of the buffer, shared memory can only be closed once no view of it is left
+        self.words.release()
+        self.bytes.release()
+
+    def hashfull(self) -> int:
+        # Permille of slots in use, estimated from the first thousand slots like the UCI 'hashfull' info
+        slots = min(1000, len(self.words) // ENTRY_WORDS)
+        return sum(1 for slot in range(slots) if self.words[slot * ENTRY_WORDS + 1]) * 1000 // slots
+
+    def stats(self) -> dict:
+        probes = self.hits + self.misses
+        return {'size_bytes': len(self.words) * 8, 'buckets': self.mask + 1, 'probes': probes, 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': self.hits / probes if probes else 0.0, 'stores': self.stores,
+                'collisions': self.collisions, 'hashfull': self.hashfull()}
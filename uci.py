@@ -0,0 +1,202 @@
+"""
+Universal Chess Interface engine for chess.py, talks to chess GUIs and tournament managers over stdin and stdout
+"""
+
+import asyncio
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from book import OpeningBook
+from chess import Game, IllegalMove
+from search import MATE, MATE_BOUND, MAX_PLY, Search, uci_move
+from transposition import TranspositionTable
+
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+DEFAULT_HASH = 16 # Megabytes
+MOVE_OVERHEAD = 0.05 # Seconds kept back from each move for the GUI and the pipes
+
+
+def uci_score(score) -> str:
+    # Mates are given in moves, positive when the engine mates
+    if abs(score) >= MATE_BOUND:
+        plies = MATE - abs(score)
+        return f'mate {(plies + 1) // 2 if score > 0 else -((plies + 1) // 2)}'
+    return f'cp {score}'
+
+
+def think_time(args, turn):
+    # Seconds to spend on a move from the 'go' arguments, None when there is no clock
+    if 'movetime' in args:
+        return max(0.01, args['movetime'] / 1000 - MOVE_OVERHEAD)
+    clock, increment = ('wtime', 'winc') if turn == 'White' else ('btime', 'binc')
+    if clock not in args:
+        return None
+    remaining = args[clock] / 1000
+    budget = remaining / max(1, args.get('movestogo', 30)) + args.get(increment, 0) / 1000 * 0.8
+    return max(0.01, min(budget, remaining / 2) - MOVE_OVERHEAD)
+
+
+class UCIEngine:
+    # Answers UCI commands on the event loop while the search runs on a thread of its own, so 'isready' and
+    # 'stop' get an answer right away even in the middle of a search
+
+    def __init__(self, write = None) -> None:
+        self.write = write or self.print_line
+        self.game = Game()
+        self.table = TranspositionTable(DEFAULT_HASH)
+        self.stop = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.searching = None # Task of the search in progress
+        self.infinite = threading.Event() # Set while a 'go infinite' search must hold back its best move until 'stop'
+        self.book = None # OpeningBook, answers without searching while the game is in it
+
+    @staticmethod
+    def print_line(line) -> None:
+        print(line, flush=True)
+
+    async def handle(self, line) -> bool:
+        # Runs one command, returns False on 'quit'
+        command, *args = line.split() or ['']
+        if command == 'uci':
+            self.write('id name Command Line Chess')
+            self.write('id author Alexander Michael Pommer Alba')
+            self.write(f'option name Hash type spin default {DEFAULT_HASH} min 1 max 4096')
+            self.write('option name BookFile type string default <empty>')
+            self.write('uciok')
+        elif command == 'isready':
+            self.write('readyok')
+        elif command == 'setoption' and len(args) >= 4 and args[1].lower() == 'hash' and args[2] == 'value':
+            await self.finish_search()
+            try:
+                self.table = TranspositionTable(int(args[3]))
+            except (ValueError, MemoryError) as error: # Not a number or too big, the table stays as it was
+                self.write(f'info string Hash {args[3]}: {str(error) or "not enough memory"}')
+        elif command == 'setoption' and len(args) >= 4 and args[1].lower() == 'bookfile' and args[2] == 'value':
+            if self.book:
+                self.book.close()
+            path = ' '.join(args[3:])
+            try:
+                self.book = OpeningBook(path) if path != '<empty>' else None
+            except OSError as error:
+                self.book = None
+                self.write(f'info string {error}')
+        elif command == 'ucinewgame':
+            await self.finish_search()
+            self.table.clear()
+            self.game = Game()
+        elif command == 'position':
+            await self.finish_search()
+            self.set_position(args)
+        elif command == 'go':
+            await self.finish_search()
+            self.go(args)
+        elif command == 'stop':
+            await self.finish_search()
+        elif command == 'quit':
+            await self.finish_search()
+            return False
+        return True
+
+    def set_position(self, args) -> None:
+        # 'position startpos [moves ...]' or 'position fen <six fields> [moves ...]'
+        moves = args.index('moves') if 'moves' in args else len(args)
+        fen = ' '.join(args[1:moves]) if args[:1] == ['fen'] else START_FEN
+        try:
+            game = Game(fen)
+        except ValueError as error: # The previous game stays
+            self.write(f'info string {error}')
+            return
+        try:
+            for uci in args[moves + 1:]:
+                game.play(uci)
+        except IllegalMove as error:
+            self.write(f'info string {error}')
+        self.game = game
+
+    def go(self, args) -> None:
+        limits = {}
+        for name, value in zip(args, args[1:]):
+            if name in ('wtime', 'btime', 'winc', 'binc', 'movestogo', 'movetime', 'depth', 'nodes') and value.lstrip('-').isdigit():
+                limits[name] = int(value)
+        self.stop.clear()
+        if 'infinite' in args:
+            self.infinite.set()
+        elif self.book:
+            move = self.book.choose(self.game.position)
+            if move:
+                self.write(f'bestmove {uci_move(move)}')
+                return
+        self.searching = asyncio.ensure_future(self.search(limits))
+
+    async def search(self, limits) -> None:
+        position = self.game.position
+        undo_depth = len(position.undo)
+        search = Search(position, self.table, self.stop)
+        movetime = think_time(limits, position.turn)
+
+        def info(depth, score, nodes, seconds, line):
+            self.write(f'info depth {depth} score {uci_score(score)} nodes {nodes} time {seconds * 1000:.0f} '
+                       f'nps {nodes / max(seconds, 1e-9):.0f} hashfull {self.table.hashfull()} pv {" ".join(uci_move(move) for move in line)}')
+
+        def run():
+            result = search.search(limits.get('depth', MAX_PLY), movetime, limits.get('nodes'), info)
+            if self.infinite.is_set():
+                self.stop.wait() # An infinite search only answers once told to stop
+            return result
+
+        try:
+            move, _, _ = await asyncio.get_running_loop().run_in_executor(self.executor, run)
+        except Exception as error: # The GUI waits for a bestmove whatever happened, so it gets the first legal move
+            while len(position.undo) > undo_depth:
+                position.unmake_move()
+            self.write(f'info string search failed: {error!r}')
+            move = self.game.legal_moves[0] if self.game.legal_moves else None
+        self.write(f'bestmove {uci_move(move) if move else "0000"}')
+
+    async def finish_search(self) -> None:
+        # Stops the search in progress and waits for it to print its best move
+        if self.searching:
+            self.infinite.clear()
+            self.stop.set()
+            try:
+                await self.searching
+            finally:
+                self.searching = None
+
+    async def run(self, lines) -> None:
+        async for line in lines:
+            if not await self.handle(line.strip()):
+                break
+        await self.finish_search()
+        self.executor.shutdown()
+
+
+async def stdin_lines():
+    # Reads stdin without blocking the event loop, through a pipe reader where the platform allows it
+    # and a thread otherwise (e.g. Windows consoles or redirected files)
+    loop = asyncio.get_running_loop()
+    try:
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    except (ValueError, OSError, NotImplementedError):
+        while True:
+            line = await loop.run_in_executor(None, sys.stdin.readline)
+            if not line:
+                return
+            yield line
+    else:
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            yield line.decode()
+
+
+def main() -> int:
+    asyncio.run(UCIEngine().run(stdin_lines()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())